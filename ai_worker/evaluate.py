@@ -0,0 +1,268 @@
+"""
+Offline replay evaluation of the /measure pipeline against editor feedback (accuracy vs cost).
+
+Reads ai_worker/ai_data/feedback_*.json (latest snapshot per measurementId), resolves each
+source image the same way train.py does (imagePath, or sourceImagePath under LOCAL_PUBLIC_DIR),
+and replays it through main._measure_image under every configuration in the grid:
+
+  --engines    heuristic,model        (model needs AI_WEIGHTS to exist)
+  --splits     default,aggressive
+  --work-dims  0,2048,1024            (0 = full resolution, otherwise bounded-memory working size)
+  --lines      auto,lsd,hough,grad    (line detection backends; fld needs opencv-contrib)
+
+Cases run in parallel across processes (one OpenCV thread each). Predictions are scored against
+the user's `added` polygons: union IoU, mean best-match IoU per user polygon and absolute area
+error. Per configuration it reports latency p50/p95, leased scratch bytes and the peak RSS growth
+of a single case (VmHWM is reset before each case via /proc/self/clear_refs), and
+marks the configurations on the latency/IoU Pareto front. Line detection time is reported
+separately (linesP50Ms) to compare backends.
+
+Usage:
+  python ai_worker/evaluate.py --jobs 4
+  python ai_worker/evaluate.py --splits aggressive --work-dims 0,1536 --out eval.json
+"""
+
+import argparse, itertools, json, os, sys, time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+from shapely.geometry import Polygon
+from shapely.ops import unary_union
+
+DATA_DIR = Path(os.environ.get("AI_DATA_DIR", "ai_data"))
+METRICS_DIR = Path("ai_worker/metrics")
+
+_main = None
+
+
+def _resolve_image_path(entry: dict) -> Optional[Path]:
+    p = entry.get("imagePath") or entry.get("image") or entry.get("image_file")
+    if isinstance(p, str) and os.path.isfile(p):
+        return Path(p)
+    src = entry.get("sourceImagePath") or entry.get("imageUrl")
+    if isinstance(src, str) and src.startswith("/"):
+        root = os.environ.get("LOCAL_PUBLIC_DIR")
+        if root and os.path.isdir(root):
+            fs = Path(root) / src.lstrip("/")
+            if fs.exists():
+                return fs
+    return None
+
+
+def _added_polygons(entry: dict) -> List[List[Tuple[float, float]]]:
+    polys = []
+    for it in entry.get("feedback") or []:
+        nf = it.get("newFeature") if isinstance(it, dict) and it.get("type") == "added" else None
+        geom = (nf or {}).get("geometry") or {}
+        if geom.get("type") != "Polygon" or not geom.get("coordinates"):
+            continue
+        ring = geom["coordinates"][0]
+        if ring and ring[0] == ring[-1]:
+            ring = ring[:-1]
+        if len(ring) >= 3:
+            polys.append([(float(x), float(y)) for x, y in ring])
+    return polys
+
+
+def load_samples(data_dir: Path) -> List[dict]:
+    """Latest feedback snapshot per measurement that has a resolvable image and user polygons."""
+    latest = {}
+    for fp in sorted(data_dir.glob("feedback_*.json")):
+        try:
+            data = json.loads(fp.read_text())
+        except Exception:
+            continue
+        mid = data.get("measurementId") or fp.stem
+        ts = fp.stem.rsplit("_", 1)[-1]
+        if mid not in latest or ts > latest[mid][0]:
+            latest[mid] = (ts, fp, data)
+    samples = []
+    for mid, (_, fp, data) in sorted(latest.items()):
+        img_path = _resolve_image_path(data)
+        gt = _added_polygons(data)
+        if img_path is None or not gt:
+            continue
+        samples.append({"name": mid, "feedback": fp.name, "image": str(img_path), "gt": gt})
+    return samples
+
+
+def _valid(ring) -> Optional[Polygon]:
+    try:
+        p = Polygon(ring)
+        if not p.is_valid:
+            p = p.buffer(0)
+        return p if not p.is_empty and p.area > 0 else None
+    except Exception:
+        return None
+
+
+def score(pred: List[list], gt: List[list]) -> dict:
+    P = [p for p in (_valid(r) for r in pred) if p is not None]
+    G = [g for g in (_valid(r) for r in gt) if g is not None]
+    pu = unary_union(P) if P else Polygon()
+    gu = unary_union(G) if G else Polygon()
+    union = pu.union(gu).area
+    iou = pu.intersection(gu).area / union if union > 0 else 0.0
+    matched = []
+    for g in G:
+        best = 0.0
+        for p in P:
+            inter = g.intersection(p).area
+            if inter > 0:
+                best = max(best, inter / g.union(p).area)
+        matched.append(best)
+    area_err = abs(pu.area - gu.area) / gu.area if gu.area > 0 else 0.0
+    return {"iou": iou, "matchedIou": float(np.mean(matched)) if matched else 0.0, "areaErr": area_err,
+            "predPlanes": len(P), "userPlanes": len(G)}
+
+
+def _init_worker():
+    global _main
+    os.environ["AI_DEDUP"] = "0"
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import cv2
+    import main as m
+    cv2.setNumThreads(1)  # after main, whose import applies the server's thread budget
+    _main = m
+
+
+def _apply_config(cfg: dict):
+    _main.ENGINE = "heuristic" if cfg["engine"] == "heuristic" else "auto"
+    _main.BOUNDED_MEMORY = cfg["workDim"] > 0
+    if cfg["workDim"] > 0:
+        _main.WORK_MAX_DIM = cfg["workDim"]
+
+
+def _reset_peak_rss() -> bool:
+    """Reset this process's VmHWM to its current RSS (Linux 4.0+)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def run_case(cfg: dict, sample: dict) -> dict:
+    _apply_config(cfg)
+    img_b = Path(sample["image"]).read_bytes()
+    exif = _main.exif_from_bytes(img_b)
+    gsd = _main.compute_gsd(exif)
+    size = _main._image_size(img_b)
+    peak_ok = _reset_peak_rss()
+    rss0, _ = _main._rss_bytes()
+    t0 = time.perf_counter()
+    err = None
+    with _main._Lease(_main._POOL if _main.BOUNDED_MEMORY else None) as lease:
+        try:
+            with _main._LINES.track() as line_ms:
+                res = _main._measure_image(img_b, size, lease, exif, gsd, split=cfg["split"], reuse=False, lines=cfg["lines"])
+        except Exception as e:
+            res, err = None, f"{type(e).__name__}: {e}"
+        leased = lease.peak_bytes
+    ms = (time.perf_counter() - t0) * 1000.0
+    _, hwm = _main._rss_bytes()
+    out = {"config": cfg["id"], "sample": sample["name"], "latencyMs": ms, "linesMs": sum(v["ms"] for v in line_ms.values()), "leasedBytes": leased,
+           "peakRssDeltaBytes": max(0, hwm - rss0) if peak_ok and hwm else None}
+    if res is None:
+        out["error"] = err or "Invalid image"
+        return out
+    out.update(score([p["polygon"] for p in res["planes"]], sample["gt"]))
+    return out
+
+
+def _pct(vals, q):
+    return float(np.percentile(vals, q)) if vals else None
+
+
+def summarize(configs: List[dict], cases: List[dict]) -> List[dict]:
+    rows = []
+    for cfg in configs:
+        cs = [c for c in cases if c["config"] == cfg["id"]]
+        ok = [c for c in cs if "error" not in c]
+        lat = [c["latencyMs"] for c in cs]
+        rows.append({
+            **cfg,
+            "cases": len(cs),
+            "errors": len(cs) - len(ok),
+            "meanIou": float(np.mean([c["iou"] for c in ok])) if ok else 0.0,
+            "meanMatchedIou": float(np.mean([c["matchedIou"] for c in ok])) if ok else 0.0,
+            "meanAreaErr": float(np.mean([c["areaErr"] for c in ok])) if ok else None,
+            "latencyP50Ms": _pct(lat, 50),
+            "latencyP95Ms": _pct(lat, 95),
+            "linesP50Ms": _pct([c["linesMs"] for c in cs], 50),
+            "maxLeasedBytes": max((c["leasedBytes"] for c in cs), default=0),
+            "maxPeakRssDeltaBytes": max((c["peakRssDeltaBytes"] for c in cs if c["peakRssDeltaBytes"] is not None), default=None),
+        })
+    # Pareto front on (latency p50 lower, mean IoU higher)
+    for r in rows:
+        r["pareto"] = r["latencyP50Ms"] is not None and not any(
+            o is not r and o["latencyP50Ms"] is not None
+            and o["latencyP50Ms"] <= r["latencyP50Ms"] and o["meanIou"] >= r["meanIou"]
+            and (o["latencyP50Ms"] < r["latencyP50Ms"] or o["meanIou"] > r["meanIou"])
+            for o in rows)
+    return rows
+
+
+def _csv(s: str) -> List[str]:
+    return [v.strip() for v in s.split(",") if v.strip()]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--data-dir", type=str, default=str(DATA_DIR))
+    ap.add_argument("--engines", type=str, default="heuristic,model")
+    ap.add_argument("--splits", type=str, default="default,aggressive")
+    ap.add_argument("--work-dims", type=str, default="0,2048,1024", help="0 = full resolution")
+    ap.add_argument("--lines", type=str, default="auto,lsd,hough,grad")
+    ap.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--limit", type=int, default=0, help="Evaluate at most N samples")
+    ap.add_argument("--out", type=str, default="", help="JSON report path (default ai_worker/metrics/eval_<ts>.json)")
+    args = ap.parse_args()
+
+    samples = load_samples(Path(args.data_dir))
+    if args.limit:
+        samples = samples[:args.limit]
+    if not samples:
+        raise RuntimeError("No evaluation samples. Ensure LOCAL_PUBLIC_DIR is set and feedback JSON includes sourceImagePath or imagePath.")
+
+    engines = _csv(args.engines)
+    weights = Path(os.environ.get("AI_WEIGHTS", "ai_worker/weights/roofplanes.pt"))
+    if "model" in engines and not weights.exists():
+        print(f"[eval] No weights at {weights}; skipping model configs")
+        engines = [e for e in engines if e != "model"]
+    configs = []
+    for engine, split, wd, lines in itertools.product(engines, _csv(args.splits), [int(v) for v in _csv(args.work_dims)], _csv(args.lines)):
+        configs.append({"id": f"{engine}/{split}/{wd or 'full'}/{lines}", "engine": engine, "split": split, "workDim": wd, "lines": lines})
+    print(f"[eval] {len(samples)} samples x {len(configs)} configs on {args.jobs} processes")
+
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker) as pool:
+        futs = [pool.submit(run_case, cfg, s) for cfg in configs for s in samples]
+        cases = [f.result() for f in futs]
+    rows = summarize(configs, cases)
+
+    print(f"{'config':40s} {'IoU':>6s} {'mIoU':>6s} {'areaErr':>8s} {'p50ms':>8s} {'p95ms':>8s} {'linesMs':>8s} {'leasedMB':>9s} {'rssMB':>7s}  pareto")
+    for r in sorted(rows, key=lambda r: (r["latencyP50Ms"] or 0)):
+        ae = f"{r['meanAreaErr']:.3f}" if r["meanAreaErr"] is not None else "-"
+        rss = f"{r['maxPeakRssDeltaBytes'] / 2**20:.0f}" if r["maxPeakRssDeltaBytes"] is not None else "-"
+        print(f"{r['id']:40s} {r['meanIou']:6.3f} {r['meanMatchedIou']:6.3f} {ae:>8s} {r['latencyP50Ms']:8.0f} {r['latencyP95Ms']:8.0f} {r['linesP50Ms']:8.1f} "
+              f"{r['maxLeasedBytes'] / 2**20:9.1f} {rss:>7s}  {'*' if r['pareto'] else ''}"
+              + (f"  ({r['errors']} errors)" if r["errors"] else ""))
+
+    report = {"createdAt": int(time.time()), "wallSeconds": time.time() - t0, "jobs": args.jobs,
+              "samples": [{k: s[k] for k in ("name", "feedback", "image")} for s in samples],
+              "configs": rows, "cases": cases}
+    if args.out:
+        out = Path(args.out)
+    else:
+        METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        out = METRICS_DIR / f"eval_{report['createdAt']}.json"
+    out.write_text(json.dumps(report, indent=2))
+    print(f"[eval] Report -> {out}")
+
+
+if __name__ == "__main__":
+    main()
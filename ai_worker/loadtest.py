@@ -0,0 +1,363 @@
+"""
+Concurrent load test for the AI worker's /measure and /stitch endpoints.
+
+Drives the FastAPI app in-process (default) or a running worker over HTTP (--url) with a
+closed loop of --concurrency clients, or an open loop of Poisson arrivals at --rate req/s.
+The request mix comes from --mix (e.g. measure=0.8,stitch=0.2). Inputs are --images /
+--stitch-images globs, or deterministic synthetic scenes when omitted.
+
+So the YOLO path can be exercised without real weights, the in-process target and `serve`
+install a small deterministic stand-in model. It returns fixed roof-plane masks and burns a
+fixed amount of convolution work per call (--model-work passes over an imgsz^2 tensor).
+
+Reports throughput, p50/p95/p99 latency and error rate per endpoint, plus RSS over time. The
+JSON report records the git commit, seed and all settings so runs compare across commits.
+
+Usage:
+  python ai_worker/loadtest.py run --concurrency 4 --duration 60
+  python ai_worker/loadtest.py run --rate 2 --requests 200 --mix measure=1 --engine heuristic
+  python ai_worker/loadtest.py serve --port 8090          # worker with the stand-in model
+  python ai_worker/loadtest.py run --url http://127.0.0.1:8090 --pid <server pid>
+
+Requires httpx (pip install httpx) in addition to requirements.txt.
+"""
+
+import argparse, asyncio, glob, json, os, random, subprocess, sys, threading, time
+from pathlib import Path
+from typing import List, Optional
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+METRICS_DIR = Path("ai_worker/metrics")
+
+
+class _Tensor:
+    # Just enough of torch.Tensor for main._measure_image: .cpu().numpy()
+    def __init__(self, arr: np.ndarray):
+        self._arr = arr
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self._arr
+
+
+class _Masks:
+    def __init__(self, arr: np.ndarray):
+        self.data = _Tensor(arr)
+
+
+class _Prediction:
+    def __init__(self, masks: np.ndarray):
+        self.masks = _Masks(masks) if len(masks) else None
+
+
+class StandInModel:
+    """Deterministic replacement for the Ultralytics model: two roof planes splitting the
+    central 60% of the frame, plus fixed CPU work to stand in for inference cost."""
+    def __init__(self, work: int = 20):
+        self.work = work
+        self._kernel = np.full((3, 3), 1.0 / 9.0, np.float32)
+
+    def predict(self, source: np.ndarray, imgsz: int = 1024, conf: float = 0.25, verbose: bool = False):
+        t = np.full((imgsz, imgsz), 0.5, np.float32)
+        for _ in range(self.work):
+            t = cv2.filter2D(t, -1, self._kernel)
+        h, w = source.shape[:2]
+        x0, x1 = int(0.2 * w), int(0.8 * w)
+        y0, ym, y1 = int(0.2 * h), int(0.5 * h), int(0.8 * h)
+        masks = np.zeros((2, h, w), np.float32)
+        masks[0, y0:ym, x0:x1] = 1.0
+        masks[1, ym:y1, x0:x1] = 1.0
+        return [_Prediction(masks)]
+
+
+def install_standin(main_mod, work: int, engine: str):
+    if engine == "heuristic":
+        main_mod.ENGINE = "heuristic"
+    else:
+        main_mod.ENGINE = "auto"
+        # With a factory each concurrent inference gets its own instance, as with real weights
+        main_mod._install_model(StandInModel(work), lambda: StandInModel(work))
+
+
+def synthetic_roof(w: int, h: int, seed: int) -> bytes:
+    rng = np.random.default_rng(seed)
+    img = np.zeros((h, w, 3), np.uint8)
+    img[:] = (40, 140, 60)
+    img = (img + rng.integers(0, 20, img.shape)).astype(np.uint8)
+    top = (np.array([[0.29, 0.28], [0.71, 0.28], [0.71, 0.5], [0.29, 0.5]]) * [w, h]).astype(np.int32)
+    bot = (np.array([[0.29, 0.5], [0.71, 0.5], [0.71, 0.72], [0.29, 0.72]]) * [w, h]).astype(np.int32)
+    cv2.fillPoly(img, [top], (120, 120, 130))
+    cv2.fillPoly(img, [bot], (90, 90, 100))
+    ok, jpg = cv2.imencode(".jpg", img, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+    return jpg.tobytes()
+
+
+def synthetic_flight(n: int, w: int, h: int, seed: int) -> List[bytes]:
+    """n overlapping strips of one feature-rich scene (stitchable with SCANS)."""
+    rng = np.random.default_rng(seed)
+    step = int(w * 0.6)
+    W = w + step * (n - 1)
+    scene = np.full((h, W, 3), 90, np.uint8)
+    for _ in range(int(W * h / 700)):
+        x, y, s = int(rng.integers(0, W)), int(rng.integers(0, h)), int(rng.integers(4, 30))
+        c = tuple(int(v) for v in rng.integers(0, 255, 3))
+        if rng.random() < 0.5:
+            cv2.rectangle(scene, (x, y), (x + s, y + int(rng.integers(4, 30))), c, -1)
+        else:
+            cv2.putText(scene, chr(65 + int(rng.integers(0, 26))), (x, y), cv2.FONT_HERSHEY_SIMPLEX, s / 20, c, 2)
+    out = []
+    for i in range(n):
+        ok, jpg = cv2.imencode(".jpg", scene[:, i * step:i * step + w], [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+        out.append(jpg.tobytes())
+    return out
+
+
+def _rss_of(pid: Optional[int]) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except Exception:
+        return None
+    return None
+
+
+class RssSampler(threading.Thread):
+    # A thread, not a task: CPU-bound handlers block the event loop in-process
+    def __init__(self, pid: Optional[int], interval: float):
+        super().__init__(daemon=True)
+        self.pid, self.interval = pid, interval
+        self.samples: List[List[float]] = []
+        self._done = threading.Event()
+        self._t0 = time.perf_counter()
+
+    def run(self):
+        while not self._done.is_set():
+            rss = _rss_of(self.pid)
+            if rss is not None:
+                self.samples.append([round(time.perf_counter() - self._t0, 3), rss])
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+
+
+def _pct(vals, q):
+    return float(np.percentile(vals, q)) if vals else None
+
+
+def _parse_mix(s: str) -> dict:
+    mix = {}
+    for part in s.split(","):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            mix[k.strip()] = float(v)
+    return {k: v for k, v in mix.items() if v > 0 and k in ("measure", "stitch")}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent).stdout.strip() or None
+    except Exception:
+        return None
+
+
+async def run_load(args) -> dict:
+    import httpx
+
+    rng = random.Random(args.seed)
+    if args.images:
+        measure_inputs = [Path(p).read_bytes() for p in sorted(glob.glob(args.images))]
+    else:
+        measure_inputs = [synthetic_roof(args.size[0], args.size[1], args.seed + i) for i in range(4)]
+    if args.stitch_images:
+        stitch_inputs = [[Path(p).read_bytes() for p in sorted(glob.glob(args.stitch_images))]]
+    else:
+        stitch_inputs = [synthetic_flight(args.stitch_n, 600, 800, args.seed + i) for i in range(2)]
+    mix = _parse_mix(args.mix)
+    if not mix:
+        raise SystemExit("--mix selects nothing")
+    kinds, weights = list(mix), list(mix.values())
+
+    pid = args.pid
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url.rstrip("/"), timeout=args.timeout)
+    else:
+        os.environ.setdefault("AI_DEDUP", "0")  # repeated inputs would otherwise hit the near-duplicate index
+        os.environ.setdefault("AI_SINGLE_FLIGHT", "0")  # ... or share one computation when in flight together
+        import main as main_mod
+        install_standin(main_mod, args.model_work, args.engine)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main_mod.app), base_url="http://loadtest", timeout=args.timeout)
+        pid = None
+
+    results = []
+    counter = {"n": 0}
+    # In-process the worker is this process; over --url only the server's pid says anything
+    sampler = RssSampler(pid, args.sample_interval) if pid or not args.url else None
+    if sampler is None:
+        print("[load] --url without --pid: worker RSS is not sampled")
+    else:
+        sampler.start()
+    t_start = time.perf_counter()
+    deadline = t_start + args.duration if args.duration else None
+
+    def next_request():
+        if args.requests and counter["n"] >= args.requests:
+            return None
+        if deadline and time.perf_counter() >= deadline:
+            return None
+        counter["n"] += 1
+        kind = rng.choices(kinds, weights)[0]
+        i = counter["n"]
+        if kind == "measure":
+            return kind, {"files": {"file": (f"img{i}.jpg", measure_inputs[i % len(measure_inputs)], "image/jpeg")}, "params": {"split": args.split}}
+        flight = stitch_inputs[i % len(stitch_inputs)]
+        return kind, {"files": [("files", (f"s{j}.jpg", b, "image/jpeg")) for j, b in enumerate(flight)]}
+
+    async def send(kind, req, t0=None):
+        # t0 is the scheduled arrival in open-loop mode, so time queued for a client slot counts
+        t0 = t0 if t0 is not None else time.perf_counter()
+        t_send = time.perf_counter()
+        status, err, coalesced = None, None, False
+        try:
+            r = await client.post(f"/{kind}", **req)
+            status = r.status_code
+            coalesced = r.headers.get("x-coalesced") == "1"
+            await r.aread()
+        except Exception as e:
+            err = f"{type(e).__name__}: {e}"
+        results.append({"kind": kind, "start": t0 - t_start, "latencyMs": (time.perf_counter() - t0) * 1000.0,
+                        "queuedMs": (t_send - t0) * 1000.0, "status": status, "coalesced": coalesced, "error": err})
+
+    if args.rate:
+        # Open loop: Poisson arrivals, in-flight capped at --concurrency. Latency runs from the
+        # scheduled arrival, not from when a slot frees up (no coordinated omission).
+        sem = asyncio.Semaphore(args.concurrency)
+        tasks = []
+
+        async def guarded(kind, req, arrival):
+            async with sem:
+                await send(kind, req, arrival)
+
+        while True:
+            nxt = next_request()
+            if nxt is None:
+                break
+            tasks.append(asyncio.create_task(guarded(*nxt, time.perf_counter())))
+            await asyncio.sleep(rng.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+    else:
+        async def client_loop():
+            while True:
+                nxt = next_request()
+                if nxt is None:
+                    return
+                await send(*nxt)
+        await asyncio.gather(*(client_loop() for _ in range(args.concurrency)))
+
+    wall = time.perf_counter() - t_start
+    if sampler is not None:
+        sampler.stop()
+    await client.aclose()
+
+    endpoints = {}
+    for kind in kinds + ["all"]:
+        rs = [r for r in results if kind == "all" or r["kind"] == kind]
+        lat = [r["latencyMs"] for r in rs]
+        ok = [r for r in rs if r["status"] == 200]
+        computed = [r for r in ok if not r["coalesced"]]
+        endpoints[kind] = {
+            "requests": len(rs),
+            "ok": len(ok),
+            "errorRate": (1 - len(ok) / len(rs)) if rs else 0.0,
+            "statuses": {str(s): sum(1 for r in rs if r["status"] == s) for s in sorted({r["status"] for r in rs}, key=str)},
+            "coalesced": len(ok) - len(computed),
+            # Coalesced duplicates did no work of their own, so they do not count as throughput
+            "throughputRps": len(computed) / wall if wall > 0 else 0.0,
+            "p50Ms": _pct(lat, 50),
+            "p95Ms": _pct(lat, 95),
+            "p99Ms": _pct(lat, 99),
+            "queuedP95Ms": _pct([r["queuedMs"] for r in rs], 95),
+        }
+    rss = [s[1] for s in sampler.samples] if sampler is not None else []
+    return {
+        "commit": _git_commit(),
+        "createdAt": int(time.time()),
+        "target": args.url or "in-process",
+        "settings": vars(args),
+        "wallSeconds": wall,
+        "endpoints": endpoints,
+        "rss": {"peakBytes": max(rss) if rss else None, "samples": sampler.samples} if sampler is not None else None,
+        "requests": results,
+    }
+
+
+def cmd_run(args):
+    report = asyncio.run(run_load(args))
+    print(f"[load] {report['target']} commit={report['commit']} wall={report['wallSeconds']:.1f}s")
+    print(f"{'endpoint':10s} {'reqs':>6s} {'err%':>6s} {'rps':>7s} {'coal':>5s} {'p50ms':>8s} {'p95ms':>8s} {'p99ms':>8s}")
+    for kind, e in report["endpoints"].items():
+        if not e["requests"]:
+            continue
+        print(f"{kind:10s} {e['requests']:6d} {100 * e['errorRate']:6.1f} {e['throughputRps']:7.2f} {e['coalesced']:5d} {e['p50Ms']:8.0f} {e['p95Ms']:8.0f} {e['p99Ms']:8.0f}")
+    if report["rss"] and report["rss"]["peakBytes"]:
+        print(f"[load] peak RSS {report['rss']['peakBytes'] / 2**20:.0f} MB")
+    if args.out:
+        out = Path(args.out)
+    else:
+        METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        out = METRICS_DIR / f"load_{report['commit'] or 'nogit'}_{report['createdAt']}.json"
+    out.write_text(json.dumps(report, indent=2))
+    print(f"[load] Report -> {out}")
+
+
+def cmd_serve(args):
+    import uvicorn
+    import main as main_mod
+    install_standin(main_mod, args.model_work, args.engine)
+    print(f"[load] serving pid={os.getpid()} on :{args.port} engine={args.engine}")
+    uvicorn.run(main_mod.app, host=args.host, port=args.port)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    for name in ("run", "serve"):
+        p = sub.add_parser(name)
+        p.add_argument("--engine", choices=["standin", "heuristic"], default="standin",
+                       help="standin: deterministic fake YOLO model; heuristic: GrabCut pipeline")
+        p.add_argument("--model-work", type=int, default=20, help="Stand-in inference cost (filter passes)")
+    run = sub.choices["run"]
+    run.add_argument("--url", type=str, default="", help="Worker base URL; default drives the app in-process")
+    run.add_argument("--pid", type=int, default=None, help="Server pid for RSS sampling in --url mode")
+    run.add_argument("--concurrency", type=int, default=4)
+    run.add_argument("--rate", type=float, default=0.0, help="Open-loop arrivals per second (0 = closed loop)")
+    run.add_argument("--duration", type=float, default=30.0, help="Seconds to generate load (0 = until --requests)")
+    run.add_argument("--requests", type=int, default=0, help="Stop after N requests")
+    run.add_argument("--mix", type=str, default="measure=0.8,stitch=0.2")
+    run.add_argument("--split", type=str, default="aggressive")
+    run.add_argument("--images", type=str, default="", help="Glob of /measure images")
+    run.add_argument("--stitch-images", type=str, default="", help="Glob of one flight for /stitch")
+    run.add_argument("--stitch-n", type=int, default=3, help="Synthetic flight length")
+    run.add_argument("--size", type=int, nargs=2, default=[1200, 900], metavar=("W", "H"))
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--timeout", type=float, default=300.0)
+    run.add_argument("--sample-interval", type=float, default=0.5)
+    run.add_argument("--out", type=str, default="")
+    serve = sub.choices["serve"]
+    serve.add_argument("--host", type=str, default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8090)
+    args = ap.parse_args()
+    if args.cmd == "run" and not args.duration and not args.requests:
+        ap.error("set --duration or --requests")
+    cmd_run(args) if args.cmd == "run" else cmd_serve(args)
+
+
+if __name__ == "__main__":
+    main()
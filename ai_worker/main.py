@@ -1,9 +1,12 @@
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.responses import JSONResponse, FileResponse
 import uvicorn, cv2, numpy as np
 from typing import Optional, List, Tuple
 from pathlib import Path
-import json, time, os
+import json, time, os, asyncio, threading, re, uuid, hashlib, queue, mmap, tempfile, shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import OrderedDict
 try:
     from shapely.geometry import Polygon, LineString
     from shapely.ops import split as shapely_split
@@ -18,27 +21,552 @@ app = FastAPI()
 AI_DATA_DIR = Path(os.environ.get("AI_DATA_DIR", "ai_data"))
 AI_DATA_DIR.mkdir(parents=True, exist_ok=True)
 WEIGHTS_PATH = Path(os.environ.get("AI_WEIGHTS", "ai_worker/weights/roofplanes.pt"))
+ENGINE = os.environ.get("AI_ENGINE", "auto").strip().lower()  # auto (model when weights exist) | heuristic
+LINE_DETECTOR = os.environ.get("AI_LINE_DETECTOR", "auto").strip().lower()  # auto | fld | lsd | hough | grad (see _LINES)
+
+# --- CPU thread budget ---
+# OpenCV, Torch and uvicorn each assume they own every core; concurrent requests then
+# oversubscribe the host. Each worker gets AI_CPU_THREADS cores (default: all cores divided
+# by AI_WORKERS), optionally pinned to a disjoint core set (AI_CPU_PIN=1), and heavy stages
+# are capped per worker (AI_MAX_STITCH / AI_MAX_INFER / AI_MAX_SEGMENT concurrent calls).
+try:
+    _ALL_CORES = sorted(os.sched_getaffinity(0))
+except Exception:
+    _ALL_CORES = list(range(os.cpu_count() or 1))
+WORKERS_PER_HOST = max(1, int(os.environ.get("AI_WORKERS", "1")))
+CPU_THREADS = int(os.environ.get("AI_CPU_THREADS", "0")) or max(1, len(_ALL_CORES) // WORKERS_PER_HOST)
+CPU_PIN = os.environ.get("AI_CPU_PIN", "").strip().lower() in ("1", "true", "on", "yes")
+STAGE_LIMITS = {
+    "stitch": int(os.environ.get("AI_MAX_STITCH", "1")),
+    "inference": int(os.environ.get("AI_MAX_INFER", "2")),
+    "segment": int(os.environ.get("AI_MAX_SEGMENT", "2")),
+}
+# Intra-op threads per heavy call, so the allowed concurrent inferences share the budget
+INTRA_THREADS = int(os.environ.get("AI_INTRA_THREADS", "0")) or max(1, CPU_THREADS // max(1, STAGE_LIMITS["inference"]))
+for _var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+    os.environ.setdefault(_var, str(INTRA_THREADS))  # read by torch, imported lazily; numpy's BLAS pool is already up
+
+_SLOT_FILE = None
+def _claim_worker_slot() -> Optional[int]:
+    """Worker index from AI_WORKER_INDEX, else the first free lock file under AI_DATA_DIR/cpu_slots
+    (held for the process lifetime, so `uvicorn --workers N` processes get distinct slots)."""
+    global _SLOT_FILE
+    if os.environ.get("AI_WORKER_INDEX", "").isdigit():
+        return int(os.environ["AI_WORKER_INDEX"])
+    try:
+        import fcntl
+        d = AI_DATA_DIR / "cpu_slots"
+        d.mkdir(parents=True, exist_ok=True)
+        for i in range(WORKERS_PER_HOST):
+            f = open(d / f"slot{i}.lock", "w")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            _SLOT_FILE = f
+            return i
+    except Exception:
+        pass
+    return None
+
+WORKER_SLOT: Optional[int] = None
+PINNED_CORES: Optional[List[int]] = None
+if CPU_PIN:
+    WORKER_SLOT = _claim_worker_slot()
+    if WORKER_SLOT is not None:
+        _cores = _ALL_CORES[WORKER_SLOT * CPU_THREADS:(WORKER_SLOT + 1) * CPU_THREADS]
+        try:
+            if _cores:
+                os.sched_setaffinity(0, _cores)
+                PINNED_CORES = _cores
+        except Exception:
+            PINNED_CORES = None
+cv2.setNumThreads(INTRA_THREADS)
+
+def _apply_torch_threads():
+    import sys
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return
+    try:
+        torch.set_num_threads(INTRA_THREADS)
+    except Exception:
+        pass
+
+class _StageScheduler:
+    """Caps how many heavy stages (stitch, inference, segment) run at once across request threads.
+    Requests are dispatched onto per-endpoint executors ("lanes") sized to those caps, so queued
+    work waits in the executor queue rather than holding a thread of the event loop's default
+    executor; stage semaphores then only ever block threads of their own lane."""
+    def __init__(self, limits: dict, lanes: dict):
+        self.limits = {k: v for k, v in limits.items() if v > 0}
+        self._sems = {k: threading.BoundedSemaphore(v) for k, v in self.limits.items()}
+        self._lock = threading.Lock()
+        self.active = {k: 0 for k in self.limits}
+        self.waiting = {k: 0 for k in self.limits}
+        self.completed = {k: 0 for k in self.limits}
+        self.wait_s = {k: 0.0 for k in self.limits}
+        self.lanes = lanes
+        self._executors = {k: ThreadPoolExecutor(max_workers=n, thread_name_prefix=f"ai-{k}") for k, n in lanes.items()}
+        self.queued = {k: 0 for k in lanes}
+
+    async def run(self, lane: str, fn, *args):
+        """Run fn(*args) on the lane's executor and await the result."""
+        with self._lock:
+            self.queued[lane] += 1
+        def call():
+            with self._lock:
+                self.queued[lane] -= 1
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executors[lane], call)
+
+    @contextmanager
+    def stage(self, name: str):
+        sem = self._sems.get(name)
+        if sem is None:
+            yield
+            return
+        t0 = time.perf_counter()
+        with self._lock:
+            self.waiting[name] += 1
+        sem.acquire()
+        with self._lock:
+            self.waiting[name] -= 1
+            self.active[name] += 1
+            self.wait_s[name] += time.perf_counter() - t0
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active[name] -= 1
+                self.completed[name] += 1
+            sem.release()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {k: {"limit": self.limits[k], "active": self.active[k], "waiting": self.waiting[k],
+                        "completed": self.completed[k], "waitSeconds": round(self.wait_s[k], 3)} for k in self.limits}
+
+    def lanes_snapshot(self) -> dict:
+        with self._lock:
+            return {k: {"threads": n, "queued": self.queued[k]} for k, n in self.lanes.items()}
+
+# /measure passes through inference then segmentation, so its lane can hold both stages' quota
+_STAGES = _StageScheduler(STAGE_LIMITS, {
+    "stitch": STAGE_LIMITS["stitch"] if STAGE_LIMITS["stitch"] > 0 else CPU_THREADS,
+    "measure": sum(STAGE_LIMITS[s] if STAGE_LIMITS[s] > 0 else CPU_THREADS for s in ("inference", "segment")),
+})
 
 # Optional Ultralytics model (lazy-load)
-_YOLO = None
 _MODEL = None
+_MODEL_FACTORY = None  # builds another instance for concurrent inference
+_MODEL_LOCK = threading.Lock()
+# One YOLO instance must not predict concurrently; the inference stage checks out its own
+_MODEL_POOL: "queue.LifoQueue" = queue.LifoQueue()
 def _maybe_load_model():
-    global _YOLO, _MODEL
+    if ENGINE == "heuristic":
+        return None
     if _MODEL is not None:
         return _MODEL
     if not WEIGHTS_PATH.exists():
         return None
+    with _MODEL_LOCK:
+        if _MODEL is not None:
+            return _MODEL
+        try:
+            from ultralytics import YOLO as _U
+            _install_model(_U(str(WEIGHTS_PATH)), lambda: _U(str(WEIGHTS_PATH)))
+            _apply_torch_threads()
+            return _MODEL
+        except Exception:
+            return None
+
+def _install_model(model, factory=None):
+    """Make model the primary instance; factory (if given) creates more for concurrent inference."""
+    global _MODEL, _MODEL_FACTORY
+    _MODEL = model
+    _MODEL_FACTORY = factory
+    while True:
+        try:
+            _MODEL_POOL.get_nowait()
+        except queue.Empty:
+            break
+    _MODEL_POOL.put(model)
+
+@contextmanager
+def _model_instance(primary):
+    """Exclusive model for one predict call. At most AI_MAX_INFER instances exist because callers
+    hold the inference stage; a model installed without a factory is shared under a lock."""
     try:
-        from ultralytics import YOLO as _U
-        _YOLO = _U
-        _MODEL = _U(str(WEIGHTS_PATH))
-        return _MODEL
-    except Exception:
-        return None
+        m = _MODEL_POOL.get_nowait()
+    except queue.Empty:
+        m = None
+        if _MODEL_FACTORY is not None:
+            try:
+                m = _MODEL_FACTORY()
+            except Exception:
+                m = None
+    if m is None:
+        with _MODEL_LOCK:
+            yield primary
+        return
+    try:
+        yield m
+    finally:
+        _MODEL_POOL.put(m)
 
 @app.get("/health")
 def health():
-    return {"ok": True}
+    import sys
+    torch = sys.modules.get("torch")
+    threads = {
+        "hostCores": len(_ALL_CORES),
+        "workers": WORKERS_PER_HOST,
+        "budget": CPU_THREADS,
+        "intraOp": INTRA_THREADS,
+        "cv2": cv2.getNumThreads(),
+        "torch": torch.get_num_threads() if torch is not None else None,
+        "workerSlot": WORKER_SLOT,
+        "pinnedCores": PINNED_CORES,
+        "stages": _STAGES.snapshot(),
+        "lanes": _STAGES.lanes_snapshot(),
+    }
+    return {"ok": True, "threads": threads, "lines": _LINES.snapshot()}
+
+# --- Spooled uploads ---
+# Starlette's multipart parser spools each file part to disk past 1 MB. Handlers memory-map
+# that spool instead of `await f.read()`, decode one file at a time and close it right after,
+# so raw upload bytes never sit in Python memory. Limits apply while the body streams in.
+MAX_UPLOAD_BYTES = int(float(os.environ.get("AI_MAX_UPLOAD_MB", "80")) * 1024 * 1024)  # per file
+MAX_REQUEST_BYTES = int(float(os.environ.get("AI_MAX_REQUEST_MB", "2048")) * 1024 * 1024)  # per request body
+SPOOL_DIR = os.environ.get("AI_SPOOL_DIR", "")
+if SPOOL_DIR:
+    Path(SPOOL_DIR).mkdir(parents=True, exist_ok=True)
+    tempfile.tempdir = SPOOL_DIR
+
+# Room for a part's headers and delimiters on top of MAX_UPLOAD_BYTES of file content
+_PART_OVERHEAD = 64 * 1024
+
+class _BodyTooLarge(HTTPException):
+    def __init__(self, limit: int, what: str = "Request body"):
+        super().__init__(status_code=413, detail=f"{what} exceeds {limit} bytes")
+
+@app.exception_handler(_BodyTooLarge)
+async def _body_too_large(request, exc: _BodyTooLarge):
+    return JSONResponse({"error": exc.detail}, status_code=413)
+
+def _multipart_boundary(headers: dict) -> Optional[bytes]:
+    ctype = headers.get(b"content-type", b"")
+    if not ctype.lower().startswith(b"multipart/"):
+        return None
+    for param in ctype.split(b";")[1:]:
+        name, _, value = param.strip().partition(b"=")
+        if name.lower() == b"boundary" and value:
+            return value.strip(b'"')
+    return None
+
+class _PartMeter:
+    """Size of the multipart part currently streaming in, found by scanning each body chunk for
+    the boundary delimiter (which may straddle two chunks)."""
+    def __init__(self, boundary: bytes):
+        self.delim = b"\r\n--" + boundary
+        self.tail = b""
+        self.part = 0
+
+    def feed(self, chunk: bytes) -> int:
+        """Largest part size seen up to the end of `chunk`, for parts ending in it or still open."""
+        d = self.delim
+        start = largest = 0
+        # A delimiter split across the previous chunk and this one
+        if self.tail and (self.tail + chunk[:len(d) - 1]).find(d) >= 0:
+            largest, self.part = self.part, 0
+            start = (self.tail + chunk).find(d) + len(d) - len(self.tail)
+        pos = chunk.find(d, start)
+        while pos >= 0:
+            largest = max(largest, self.part + pos - start)
+            self.part, start = 0, pos + len(d)
+            pos = chunk.find(d, start)
+        self.part += len(chunk) - start
+        self.tail = (self.tail + chunk[-(len(d) - 1):])[-(len(d) - 1):]
+        return max(largest, self.part)
+
+class _BodyLimitMiddleware:
+    """Counts request body bytes as they arrive and aborts with 413 once over the limit,
+    before the rest of the upload is received and spooled. `route_limits` tightens the total
+    for single-file routes; `max_part_bytes` caps each multipart part of any request."""
+    def __init__(self, app, max_bytes: int, max_part_bytes: int = 0, route_limits: Optional[dict] = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.max_part_bytes = max_part_bytes
+        self.route_limits = route_limits or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        limit = self.route_limits.get(scope.get("path"), self.max_bytes)
+        headers = dict(scope.get("headers") or [])
+        boundary = _multipart_boundary(headers) if self.max_part_bytes > 0 else None
+        if limit <= 0 and boundary is None:
+            return await self.app(scope, receive, send)
+        declared = headers.get(b"content-length")
+        if limit > 0 and declared and declared.isdigit() and int(declared) > limit:
+            return await JSONResponse({"error": f"Request body exceeds {limit} bytes"}, status_code=413)(scope, receive, send)
+        meter = _PartMeter(boundary) if boundary else None
+        seen = 0
+        async def limited_receive():
+            nonlocal seen
+            msg = await receive()
+            if msg["type"] == "http.request":
+                body = msg.get("body", b"")
+                seen += len(body)
+                if limit > 0 and seen > limit:
+                    raise _BodyTooLarge(limit)
+                if meter is not None and meter.feed(body) > self.max_part_bytes:
+                    raise _BodyTooLarge(self.max_part_bytes, "Upload part")
+            return msg
+        await self.app(scope, limited_receive, send)
+
+_MAX_PART_BYTES = MAX_UPLOAD_BYTES + _PART_OVERHEAD if MAX_UPLOAD_BYTES > 0 else 0
+# /measure takes one file, so its whole body is held to about one upload
+_MEASURE_BODY_BYTES = min((b for b in (MAX_REQUEST_BYTES, _MAX_PART_BYTES) if b > 0), default=0)
+app.add_middleware(_BodyLimitMiddleware, max_bytes=MAX_REQUEST_BYTES, max_part_bytes=_MAX_PART_BYTES,
+                   route_limits={"/measure": _MEASURE_BODY_BYTES})
+
+def _as_stream(b):
+    # PIL wants a file object; an mmap already is one, bytes need wrapping
+    if isinstance(b, mmap.mmap):
+        b.seek(0)
+        return b
+    return io.BytesIO(b)
+
+def _upload_size(f: UploadFile) -> int:
+    if f.size is not None:
+        return int(f.size)
+    f.file.seek(0, os.SEEK_END)
+    n = f.file.tell()
+    f.file.seek(0)
+    return n
+
+def _map_upload(f: UploadFile):
+    """Read-only mmap over a spooled upload (b"" when empty). The map stays valid after the
+    upload itself is closed, so shared computations can outlive the request that opened it."""
+    if _upload_size(f) == 0:
+        return b""
+    fh = f.file
+    fd = fh.fileno()  # rolls a small in-memory spool over to disk
+    fh.flush()
+    return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+
+def _unmap(mm):
+    if isinstance(mm, mmap.mmap):
+        try:
+            mm.close()
+        except BufferError:
+            pass  # an array view is still alive; the map goes with it
+
+# --- Bounded-memory mode ---
+# AI_MEMORY_MODE=bounded caps the working resolution at AI_WORK_MAX_DIM and takes full-frame
+# scratch buffers from a per-worker pool instead of allocating them per request.
+# AI_MEM_BUDGET_MB (any mode) admits /measure requests only while their estimated footprint fits.
+BOUNDED_MEMORY = os.environ.get("AI_MEMORY_MODE", "").strip().lower() in ("bounded", "1", "true", "on")
+WORK_MAX_DIM = int(os.environ.get("AI_WORK_MAX_DIM", "2048"))
+MEM_BUDGET_BYTES = int(float(os.environ.get("AI_MEM_BUDGET_MB", "0")) * 1024 * 1024)  # 0 = unlimited
+MEM_QUEUE_TIMEOUT_S = float(os.environ.get("AI_MEM_QUEUE_TIMEOUT_S", "30"))
+# Rough cost of one /measure at working resolution: pooled scratch buffers (~30 B/px)
+# plus GrabCut's internal graph and GMM state (~150 B/px).
+MEASURE_BYTES_PER_PX = int(os.environ.get("AI_MEASURE_BYTES_PER_PX", "180"))
+
+class _BufferPool:
+    """Free lists of uint8 buffers keyed by shape, shared by all requests of this worker.
+    Idle buffers are capped in total bytes; the least recently returned shapes are dropped first."""
+    def __init__(self, max_free_bytes: int, max_free_per_shape: int = 8):
+        self._free: "OrderedDict[Tuple[int, ...], List[np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_free_bytes = max_free_bytes
+        self.max_free_per_shape = max_free_per_shape
+        self.allocated_bytes = 0
+        self.free_bytes = 0
+
+    def take(self, shape: Tuple[int, ...]) -> np.ndarray:
+        with self._lock:
+            free = self._free.get(shape)
+            if free:
+                b = free.pop()
+                self.free_bytes -= b.nbytes
+                if not free:
+                    del self._free[shape]
+                return b
+            self.allocated_bytes += int(np.prod(shape))
+        return np.empty(shape, np.uint8)
+
+    def give(self, buf: np.ndarray):
+        with self._lock:
+            free = self._free.get(buf.shape)
+            if buf.nbytes > self.max_free_bytes or (free is not None and len(free) >= self.max_free_per_shape):
+                self.allocated_bytes -= buf.nbytes
+                return
+            if free is None:
+                free = self._free[buf.shape] = []
+            self._free.move_to_end(buf.shape)
+            free.append(buf)
+            self.free_bytes += buf.nbytes
+            while self.free_bytes > self.max_free_bytes:
+                shape, old = next(iter(self._free.items()))
+                if not old:
+                    del self._free[shape]
+                    continue
+                dropped = old.pop(0)
+                self.free_bytes -= dropped.nbytes
+                self.allocated_bytes -= dropped.nbytes
+                if not old:
+                    del self._free[shape]
+
+    def preallocate(self, h: int, w: int):
+        # One request's worth of scratch at h x w (see the _Lease slot names in the pipeline)
+        shapes = [(h, w)] * 13 + [(h, w, 3)] * 3 + [(h + 2, w + 2)]
+        for b in [self.take(sh) for sh in shapes]:
+            self.give(b)
+
+class _Lease:
+    """Named scratch buffers borrowed for one request; asking for the same name returns the same buffer."""
+    def __init__(self, pool: Optional[_BufferPool]):
+        self.pool = pool
+        self._slots: dict = {}
+        self.leased_bytes = 0
+        self.peak_bytes = 0
+
+    def buf(self, name: str, shape: Tuple[int, ...], zero: bool = False) -> np.ndarray:
+        shape = tuple(int(s) for s in shape)
+        b = self._slots.get(name)
+        if b is None or b.shape != shape:
+            if b is not None:
+                self._give(b)
+            b = self.pool.take(shape) if self.pool is not None else np.empty(shape, np.uint8)
+            self._slots[name] = b
+            self.leased_bytes += b.nbytes
+            self.peak_bytes = max(self.peak_bytes, self.leased_bytes)
+        if zero:
+            b.fill(0)
+        return b
+
+    def _give(self, b: np.ndarray):
+        self.leased_bytes -= b.nbytes
+        if self.pool is not None:
+            self.pool.give(b)
+
+    def release(self):
+        for b in self._slots.values():
+            self._give(b)
+        self._slots = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class _MemoryBudget:
+    """Admission control: reserve a request's estimated bytes before heavy work, queueing up to a timeout."""
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self.reserved_bytes = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, nbytes: int, timeout: float) -> bool:
+        if self.budget_bytes <= 0:
+            return True
+        async with self._cond:
+            try:
+                await asyncio.wait_for(self._cond.wait_for(lambda: self.reserved_bytes + nbytes <= self.budget_bytes), timeout)
+            except asyncio.TimeoutError:
+                return False
+            self.reserved_bytes += nbytes
+            return True
+
+    async def release(self, nbytes: int):
+        if self.budget_bytes <= 0:
+            return
+        async with self._cond:
+            self.reserved_bytes -= nbytes
+            self._cond.notify_all()
+
+# Idle pool cap; default is two requests' scratch (23 planes each, see preallocate) at the maximum working size
+POOL_MAX_BYTES = int(float(os.environ.get("AI_POOL_MAX_MB", "0")) * 1024 * 1024) or 2 * 23 * WORK_MAX_DIM * WORK_MAX_DIM
+_POOL = _BufferPool(POOL_MAX_BYTES)
+_MEM_BUDGET = _MemoryBudget(MEM_BUDGET_BYTES)
+_prealloc = os.environ.get("AI_WORK_PREALLOC", "")  # e.g. "2048x1365" (WxH) to warm the pool at startup
+if BOUNDED_MEMORY and "x" in _prealloc:
+    try:
+        _pw, _ph = (int(v) for v in _prealloc.lower().split("x", 1))
+        _POOL.preallocate(_ph, _pw)
+    except Exception:
+        pass
+
+def _rss_bytes() -> Tuple[int, int]:
+    """Current and high-water resident set size of this process (0 if unavailable)."""
+    cur = hwm = 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    cur = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    hwm = int(line.split()[1]) * 1024
+    except Exception:
+        pass
+    return cur, hwm
+
+def _image_size(b) -> Optional[Tuple[int, int]]:
+    """(w, h) as displayed, from the image header without decoding pixels. cv2.imdecode applies
+    the EXIF Orientation tag, so rotated captures (5-8) report their transposed size."""
+    try:
+        im = Image.open(_as_stream(b))
+        w, h = im.size
+        try:
+            if im.getexif().get(0x0112) in (5, 6, 7, 8):
+                w, h = h, w
+        except Exception:
+            pass
+        return w, h
+    except Exception:
+        return None
+
+def _work_size(w: int, h: int) -> Tuple[int, int]:
+    if not BOUNDED_MEMORY or max(w, h) <= WORK_MAX_DIM:
+        return w, h
+    s = WORK_MAX_DIM / float(max(w, h))
+    return max(1, int(round(w * s))), max(1, int(round(h * s)))
+
+def _estimate_measure_bytes(size: Optional[Tuple[int, int]]) -> int:
+    if size is None:
+        return 0
+    ww, wh = _work_size(*size)
+    return ww * wh * MEASURE_BYTES_PER_PX
+
+def _decode_for_work(b, size: Optional[Tuple[int, int]], lease: "_Lease") -> Tuple[Optional[np.ndarray], float]:
+    """Decode the upload at working resolution. Returns (img, scale) with scale = working px / original px.
+    Large JPEGs use libjpeg's reduced decode so the full-resolution frame is never materialised."""
+    arr = np.frombuffer(b, np.uint8)
+    if size is None or _work_size(*size) == size:
+        return cv2.imdecode(arr, cv2.IMREAD_COLOR), 1.0
+    w, h = size
+    ww, wh = _work_size(w, h)
+    flag = cv2.IMREAD_COLOR
+    for factor, f in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if max(w, h) / factor >= WORK_MAX_DIM:
+            flag = f
+            break
+    im = cv2.imdecode(arr, flag)
+    if im is None:
+        return None, 1.0
+    if (im.shape[1] >= im.shape[0]) != (w >= h):
+        # Header and decoder disagree on orientation; trust the decoded frame, never change its aspect
+        w, h = h, w
+        ww, wh = _work_size(w, h)
+    if im.shape[1] != ww or im.shape[0] != wh:
+        im = cv2.resize(im, (ww, wh), dst=lease.buf("work", (wh, ww, 3)), interpolation=cv2.INTER_AREA)
+    return im, ww / float(w)
 
 SENSOR_WIDTHS_MM = {
     "DJI Phantom 4 Pro": 13.2,
@@ -48,9 +576,18 @@ SENSOR_WIDTHS_MM = {
     "PHANTOM 4": 6.17,
 }
 
-def exif_from_bytes(b: bytes):
+def _gps_degrees(dms, ref) -> Optional[float]:
+    # EXIF stores degrees/minutes/seconds as three rationals
     try:
-        im = Image.open(io.BytesIO(b))
+        d, m, sec = (float(n) / float(q) for n, q in dms)
+    except Exception:
+        return None
+    val = d + m / 60.0 + sec / 3600.0
+    return -val if ref in (b"S", b"W", "S", "W") else val
+
+def exif_from_bytes(b):
+    try:
+        im = Image.open(_as_stream(b))
         exif = im.info.get("exif")
         if not exif:
             return {}
@@ -73,6 +610,10 @@ def exif_from_bytes(b: bytes):
         alt_ref = gps.get(piexif.GPSIFD.GPSAltitudeRef, 0)
         if isinstance(alt, tuple) and alt[1] != 0:
             out["gps_altitude_m"] = (float(alt[0])/float(alt[1])) * (-1 if alt_ref == 1 else 1)
+        lat = _gps_degrees(gps.get(piexif.GPSIFD.GPSLatitude), gps.get(piexif.GPSIFD.GPSLatitudeRef, b"N"))
+        lon = _gps_degrees(gps.get(piexif.GPSIFD.GPSLongitude), gps.get(piexif.GPSIFD.GPSLongitudeRef, b"E"))
+        if lat is not None and lon is not None:
+            out["gps_lat"], out["gps_lon"] = lat, lon
         return out
     except Exception:
         return {}
@@ -138,43 +679,351 @@ def polygonize(binary_mask: np.ndarray):
         polys.append(pts)
     return polys
 
-def _detect_interior_lines(img: np.ndarray, mask: Optional[np.ndarray], max_lines: int, aggressive: bool) -> List[Tuple[Tuple[float,float], Tuple[float,float]]]:
-    """Detect strong interior ridge/valley lines using FastLineDetector (ximgproc) then return segments.
-    The mask, if provided, restricts detection to the roof region.
-    """
-    try:
-        fld = cv2.ximgproc.createFastLineDetector(_length_threshold := 10 if aggressive else 20,
-                                                  _distance_threshold := 1.414,
-                                                  _canny_th1 := 50 if aggressive else 80,
-                                                  _canny_th2 := 150 if aggressive else 200,
-                                                  _canny_aperture_size := 3,
-                                                  _do_merge := True)
-    except Exception:
-        fld = None
+# --- Line detection backends ---
+# Ridge/valley extraction and the heuristic plane cuts share one registry of line detectors,
+# selected by name (AI_LINE_DETECTOR, or ?lines= per request). OpenCV detector objects are
+# built once per worker thread and reused. Profiles: "ridge" / "ridge_aggressive" for interior
+# lines inside a polygon, "planes" for long cuts across the whole roof mask.
+# auto = FLD for ridges when opencv-contrib is installed (else Hough), Hough for plane cuts.
 
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    if mask is not None:
-        gray = cv2.bitwise_and(gray, gray, mask=mask)
-
-    segs: List[Tuple[Tuple[float,float], Tuple[float,float]]] = []
-    if fld is not None:
-        lines = fld.detect(gray)
-        if lines is not None:
-            for l in lines[:max_lines]:
-                x1, y1, x2, y2 = map(float, l[0])
-                segs.append(((x1, y1), (x2, y2)))
-    else:
-        # Fallback to HoughLinesP
-        edges = cv2.Canny(gray, 50 if aggressive else 70, 150 if aggressive else 200)
+def _planes_min_len(shape: Tuple[int, ...]) -> int:
+    return int(0.12 * min(shape[0], shape[1]))
+
+def _segment_lengths(segs: np.ndarray) -> np.ndarray:
+    return np.hypot(segs[:, 2] - segs[:, 0], segs[:, 3] - segs[:, 1])
+
+_MERGE_MAX_SEGMENTS = 1000
+_MERGE_BLOCK = 128
+
+def _merge_collinear(segs: np.ndarray, angle_tol_deg: float = 3.0, dist_tol: float = 3.0, gap_tol: float = 10.0) -> np.ndarray:
+    """Join segments that lie on a common line and overlap or nearly touch along it.
+    Pairwise tests are vectorized over row blocks (a few MB of float32 scratch at the segment cap);
+    groups are the connected components of the pair graph."""
+    n = len(segs)
+    if n < 2:
+        return segs
+    if n > _MERGE_MAX_SEGMENTS:  # bound the pair tests; drop the shortest pieces
+        segs = segs[np.argsort(-_segment_lengths(segs))[:_MERGE_MAX_SEGMENTS]]
+        n = len(segs)
+    p1, p2 = segs[:, :2].astype(np.float32), segs[:, 2:].astype(np.float32)
+    d = p2 - p1
+    length = np.maximum(np.hypot(d[:, 0], d[:, 1]), 1e-6)
+    u = d / length[:, None]
+    theta = np.arctan2(u[:, 1], u[:, 0]) % np.pi
+    mid = (p1 + p2) / 2.0
+    max_dtheta = np.radians(angle_tol_deg)
+
+    def near(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        # Segment b[j] lies along line a[i]: same direction, midpoint close, extent within gap_tol
+        dtheta = np.abs(theta[a, None] - theta[None, b])
+        dtheta = np.minimum(dtheta, np.pi - dtheta)
+        ua = u[a, None, :]
+        rel = mid[None, b, :] - p1[a, None, :]
+        perp = np.abs(rel[..., 0] * ua[..., 1] - rel[..., 1] * ua[..., 0])
+        t1 = ((p1[None, b, :] - p1[a, None, :]) * ua).sum(-1)
+        t2 = ((p2[None, b, :] - p1[a, None, :]) * ua).sum(-1)
+        gap = np.maximum(np.minimum(t1, t2) - length[a, None], 0.0) + np.maximum(-np.maximum(t1, t2), 0.0)
+        return (dtheta < max_dtheta) & (perp < dist_tol) & (gap < gap_tol)
+
+    everything = np.arange(n)
+    ii, jj = [], []
+    for s in range(0, n, _MERGE_BLOCK):
+        blk = everything[s:s + _MERGE_BLOCK]
+        adj = near(blk, everything) & near(everything, blk).T
+        bi, bj = np.nonzero(adj)
+        ii.append(blk[bi])
+        jj.append(bj)
+    ii, jj = np.concatenate(ii), np.concatenate(jj)
+    # Connected components by min-label propagation over the pair list
+    labels = everything.copy()
+    while True:
+        nxt = labels.copy()
+        np.minimum.at(nxt, ii, labels[jj])
+        nxt = nxt[nxt]
+        if np.array_equal(nxt, labels):
+            break
+        labels = nxt
+    _, group = np.unique(labels, return_inverse=True)
+    k = int(group.max()) + 1
+    if k == n:
+        return segs
+    # Length-weighted axial mean direction (doubled angles) and centre per group
+    p1, p2, mid, theta = p1.astype(np.float64), p2.astype(np.float64), mid.astype(np.float64), theta.astype(np.float64)
+    w = length.astype(np.float64)
+    c2 = np.bincount(group, w * np.cos(2 * theta), k)
+    s2 = np.bincount(group, w * np.sin(2 * theta), k)
+    phi = 0.5 * np.arctan2(s2, c2)
+    gd = np.stack([np.cos(phi), np.sin(phi)], axis=1)
+    wsum = np.bincount(group, w, k)
+    centre = np.stack([np.bincount(group, w * mid[:, 0], k), np.bincount(group, w * mid[:, 1], k)], axis=1) / wsum[:, None]
+    # Extent: project every endpoint onto its group's axis
+    pts = np.concatenate([p1, p2])
+    pg = np.concatenate([group, group])
+    t = ((pts - centre[pg]) * gd[pg]).sum(-1)
+    tmin = np.full(k, np.inf)
+    tmax = np.full(k, -np.inf)
+    np.minimum.at(tmin, pg, t)
+    np.maximum.at(tmax, pg, t)
+    a = centre + gd * tmin[:, None]
+    b = centre + gd * tmax[:, None]
+    return np.concatenate([a, b], axis=1).astype(np.float32)
+
+class _LineBackend:
+    """A named line detector. detect() returns an (N, 4) float32 array of x1, y1, x2, y2;
+    the mask (0/255), when given, restricts detection to the roof region."""
+    name = ""
+    merges = False  # True when the detector already joins collinear pieces itself
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def available(self) -> bool:
+        return True
+
+    def _cached(self, key, make):
+        cache = getattr(self._local, "cache", None)
+        if cache is None:
+            cache = self._local.cache = {}
+        obj = cache.get(key)
+        if obj is None:
+            obj = cache[key] = make()
+        return obj
+
+    def detect(self, gray: np.ndarray, mask: Optional[np.ndarray], profile: str) -> np.ndarray:
+        raise NotImplementedError
+
+def _masked(gray: np.ndarray, mask: Optional[np.ndarray]) -> np.ndarray:
+    if mask is None:
+        return gray
+    return np.bitwise_and(gray, mask, out=gray)
+
+def _inside(segs: np.ndarray, mask: Optional[np.ndarray]) -> np.ndarray:
+    # Plane cuts run on the unmasked image (the mask outline is not a ridge); keep segments centred on the roof
+    if mask is None or len(segs) == 0:
+        return segs
+    mx = np.clip(((segs[:, 0] + segs[:, 2]) / 2).astype(np.int32), 0, mask.shape[1] - 1)
+    my = np.clip(((segs[:, 1] + segs[:, 3]) / 2).astype(np.int32), 0, mask.shape[0] - 1)
+    return segs[mask[my, mx] > 0]
+
+def _as_segments(lines) -> np.ndarray:
+    if lines is None or len(lines) == 0:
+        return np.empty((0, 4), np.float32)
+    return np.asarray(lines, np.float32).reshape(-1, 4)
+
+class _FLDBackend(_LineBackend):
+    """cv2.ximgproc FastLineDetector (opencv-contrib)."""
+    name = "fld"
+    merges = True
+    # length_threshold, distance_threshold, canny_th1, canny_th2, canny_aperture_size, do_merge
+    _PARAMS = {
+        "ridge": (20, 1.414, 80, 200, 3, True),
+        "ridge_aggressive": (10, 1.414, 50, 150, 3, True),
+        "planes": (20, 1.414, 50, 150, 3, True),
+    }
+
+    def __init__(self):
+        super().__init__()
+        self._ok: Optional[bool] = None
+
+    def available(self) -> bool:
+        if self._ok is None:
+            try:
+                cv2.ximgproc.createFastLineDetector()
+                self._ok = True
+            except Exception:
+                self._ok = False
+        return self._ok
+
+    def detect(self, gray, mask, profile):
+        fld = self._cached(profile, lambda: cv2.ximgproc.createFastLineDetector(*self._PARAMS[profile]))
+        if profile == "planes":
+            segs = _inside(_as_segments(fld.detect(gray)), mask)
+            return segs[_segment_lengths(segs) >= _planes_min_len(gray.shape)]
+        return _as_segments(fld.detect(_masked(gray, mask)))
+
+class _LSDBackend(_LineBackend):
+    """OpenCV LineSegmentDetector (LSD, a-contrario validated region growing)."""
+    name = "lsd"
+    _MIN_LEN = {"ridge": 40, "ridge_aggressive": 20}
+
+    def available(self) -> bool:
+        return hasattr(cv2, "createLineSegmentDetector")
+
+    def detect(self, gray, mask, profile):
+        lsd = self._cached("lsd", lambda: cv2.createLineSegmentDetector(cv2.LSD_REFINE_STD))
+        if profile == "planes":
+            segs = _inside(_as_segments(lsd.detect(gray)[0]), mask)
+        else:
+            segs = _as_segments(lsd.detect(_masked(gray, mask))[0])
+        min_len = self._MIN_LEN.get(profile) or _planes_min_len(gray.shape)
+        return segs[_segment_lengths(segs) >= min_len]
+
+class _HoughBackend(_LineBackend):
+    """Canny edges + probabilistic Hough transform."""
+    name = "hough"
+    merges = True  # maxLineGap already bridges collinear runs
+
+    def detect(self, gray, mask, profile):
+        if profile == "planes":
+            edges = cv2.Canny(gray, 50, 150)
+            if mask is not None:
+                np.bitwise_and(edges, mask, out=edges)
+            lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=60, minLineLength=_planes_min_len(gray.shape), maxLineGap=12)
+            return _as_segments(lines)
+        aggressive = profile == "ridge_aggressive"
+        edges = cv2.Canny(_masked(gray, mask), 50 if aggressive else 70, 150 if aggressive else 200)
         lines = cv2.HoughLinesP(edges, 1, np.pi/180,
                                 threshold=60 if aggressive else 80,
                                 minLineLength=20 if aggressive else 40,
                                 maxLineGap=10 if aggressive else 12)
-        if lines is not None:
-            for ln in lines[:max_lines]:
-                x1, y1, x2, y2 = ln[0]
-                segs.append(((float(x1), float(y1)), (float(x2), float(y2))))
-    return segs
+        return _as_segments(lines)
+
+class _GradBinBackend(_LineBackend):
+    """Gradient-orientation binning (Burns-style): Canny edge pixels are grouped by quantized
+    gradient direction, each connected run is fit by its principal axis and kept when thin."""
+    name = "grad"
+    BINS = 12
+    _MIN_LEN = {"ridge": 40, "ridge_aggressive": 20}
+
+    def detect(self, gray, mask, profile):
+        aggressive = profile != "ridge"
+        g = gray if profile == "planes" else _masked(gray, mask)
+        edges = cv2.Canny(g, 50 if aggressive else 70, 150 if aggressive else 200)
+        if mask is not None and profile == "planes":
+            np.bitwise_and(edges, mask, out=edges)
+        ys, xs = np.nonzero(edges)
+        if len(xs) == 0:
+            return np.empty((0, 4), np.float32)
+        gx = cv2.Sobel(g, cv2.CV_32F, 1, 0, ksize=3)[ys, xs]
+        gy = cv2.Sobel(g, cv2.CV_32F, 0, 1, ksize=3)[ys, xs]
+        ang = np.arctan2(gy, gx) % np.pi
+        min_len = self._MIN_LEN.get(profile) or _planes_min_len(gray.shape)
+        width = np.pi / self.BINS
+        # One scratch image over the edge bounding box, set and cleared per bin
+        x0, y0 = int(xs.min()), int(ys.min())
+        bx, by = xs - x0, ys - y0
+        img = np.zeros((int(by.max()) + 1, int(bx.max()) + 1), np.uint8)
+        out = []
+        # Two half-bin-offset passes so a line near a bin edge is whole in one of them
+        for offset in (0.0, 0.5 * width):
+            b = (((ang + offset) % np.pi) // width).astype(np.int32)
+            for k in range(self.BINS):
+                sel = b == k
+                if np.count_nonzero(sel) < min_len:
+                    continue
+                img[by[sel], bx[sel]] = 255
+                segs = self._fit_runs(img, min_len)
+                img[by[sel], bx[sel]] = 0
+                segs[:, 0::2] += x0
+                segs[:, 1::2] += y0
+                out.append(segs)
+        return np.concatenate(out) if out else np.empty((0, 4), np.float32)
+
+    @staticmethod
+    def _fit_runs(img: np.ndarray, min_len: int) -> np.ndarray:
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(img, connectivity=8)
+        big = np.flatnonzero(np.maximum(stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT]) >= min_len * 0.7)
+        big = big[big > 0]
+        if len(big) == 0:
+            return np.empty((0, 4), np.float32)
+        keep = np.zeros(n, bool)
+        keep[big] = True
+        ys, xs = np.nonzero(keep[labels])
+        lab = labels[ys, xs]
+        _, grp = np.unique(lab, return_inverse=True)
+        k = len(big)
+        x, y = xs.astype(np.float64), ys.astype(np.float64)
+        cnt = np.bincount(grp, minlength=k)
+        mx, my = np.bincount(grp, x, k) / cnt, np.bincount(grp, y, k) / cnt
+        dx, dy = x - mx[grp], y - my[grp]
+        sxx, syy, sxy = np.bincount(grp, dx * dx, k), np.bincount(grp, dy * dy, k), np.bincount(grp, dx * dy, k)
+        # Principal axis and thinness (minor / major eigenvalue) per run
+        phi = 0.5 * np.arctan2(2 * sxy, sxx - syy)
+        tr, det = sxx + syy, sxx * syy - sxy * sxy
+        disc = np.sqrt(np.maximum(tr * tr / 4 - det, 0))
+        thin = (tr / 2 - disc) / np.maximum(tr / 2 + disc, 1e-9)
+        ux, uy = np.cos(phi), np.sin(phi)
+        t = dx * ux[grp] + dy * uy[grp]
+        tmin = np.full(k, np.inf)
+        tmax = np.full(k, -np.inf)
+        np.minimum.at(tmin, grp, t)
+        np.maximum.at(tmax, grp, t)
+        segs = np.stack([mx + ux * tmin, my + uy * tmin, mx + ux * tmax, my + uy * tmax], axis=1)
+        ok = (thin < 0.01) & (tmax - tmin >= min_len)
+        return segs[ok].astype(np.float32)
+
+class _LineDetectors:
+    """Registry of line backends with per-backend timing (cumulative, and per request thread)."""
+    def __init__(self, backends: List[_LineBackend], default: str):
+        self.backends = {b.name: b for b in backends}
+        self.default = default
+        self._lock = threading.Lock()
+        self.stats = {name: {"calls": 0, "ms": 0.0, "segments": 0} for name in self.backends}
+        self._local = threading.local()
+
+    def names(self) -> List[str]:
+        return ["auto"] + [n for n, b in self.backends.items() if b.available()]
+
+    def validate(self, name: Optional[str]) -> Optional[str]:
+        """Normalized backend name, or None when unknown or unavailable here."""
+        name = (name or self.default).strip().lower()
+        return name if name in self.names() else None
+
+    def resolve(self, name: Optional[str], profile: str) -> _LineBackend:
+        name = self.validate(name) or "auto"
+        if name == "auto":
+            fld = self.backends["fld"]
+            name = "fld" if profile != "planes" and fld.available() else "hough"
+        return self.backends[name]
+
+    @contextmanager
+    def track(self):
+        """Collect per-backend timings for line detection done on this thread."""
+        self._local.req = req = {}
+        try:
+            yield req
+        finally:
+            self._local.req = None
+
+    def detect(self, gray: np.ndarray, mask: Optional[np.ndarray], profile: str, name: Optional[str] = None) -> np.ndarray:
+        backend = self.resolve(name, profile)
+        t0 = time.perf_counter()
+        segs = backend.detect(gray, mask, profile)
+        if not backend.merges and len(segs) > 1:
+            segs = _merge_collinear(segs, gap_tol=12.0 if profile == "planes" else 10.0)
+            segs = segs[np.argsort(-_segment_lengths(segs), kind="stable")]
+        ms = (time.perf_counter() - t0) * 1000.0
+        with self._lock:
+            st = self.stats[backend.name]
+            st["calls"] += 1
+            st["ms"] += ms
+            st["segments"] += len(segs)
+        req = getattr(self._local, "req", None)
+        if req is not None:
+            r = req.setdefault(backend.name, {"calls": 0, "ms": 0.0, "segments": 0})
+            r["calls"] += 1
+            r["ms"] += ms
+            r["segments"] += len(segs)
+        return segs
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"default": self.default, "available": self.names(),
+                    "backends": {k: {**v, "ms": round(v["ms"], 1)} for k, v in self.stats.items() if v["calls"]}}
+
+_LINES = _LineDetectors([_FLDBackend(), _LSDBackend(), _HoughBackend(), _GradBinBackend()], LINE_DETECTOR)
+if _LINES.validate(LINE_DETECTOR) is None:
+    print(f"[lines] AI_LINE_DETECTOR={LINE_DETECTOR!r} is unknown or unavailable here (available: {', '.join(_LINES.names())}); using auto")
+    _LINES.default = "auto"
+
+def _detect_interior_lines(img: np.ndarray, mask: Optional[np.ndarray], max_lines: int, aggressive: bool, lease: Optional["_Lease"] = None, lines: Optional[str] = None) -> List[Tuple[Tuple[float,float], Tuple[float,float]]]:
+    """Detect strong interior ridge/valley lines with the selected backend and return segments.
+    The mask, if provided (0/255), restricts detection to the roof region.
+    """
+    lease = lease or _Lease(None)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=lease.buf("lines_gray", img.shape[:2]))
+    segs = _LINES.detect(gray, mask, "ridge_aggressive" if aggressive else "ridge", lines)
+    return [((float(x1), float(y1)), (float(x2), float(y2))) for x1, y1, x2, y2 in segs[:max_lines]]
 
 def _extend_to_bounds(p1: Tuple[float,float], p2: Tuple[float,float], bounds: Tuple[float,float,float,float]):
     (x1,y1),(x2,y2) = p1, p2
@@ -193,7 +1042,7 @@ def _extend_to_bounds(p1: Tuple[float,float], p2: Tuple[float,float], bounds: Tu
     inter = ln.intersection(big)
     return inter if not inter.is_empty else ln
 
-def _split_polygon_by_lines(ring: list, img: np.ndarray, mask: Optional[np.ndarray] = None, aggressive: bool = False) -> List[list]:
+def _split_polygon_by_lines(ring: list, img: np.ndarray, mask: Optional[np.ndarray] = None, aggressive: bool = False, lease: Optional["_Lease"] = None, lines: Optional[str] = None) -> List[list]:
     """Split a polygon by detected interior lines. Works even for moderate-size polygons.
     If no lines found or split fails, returns [ring].
     """
@@ -204,14 +1053,15 @@ def _split_polygon_by_lines(ring: list, img: np.ndarray, mask: Optional[np.ndarr
         return [ring]
     h, w = img.shape[:2]
     # Detect lines restricted to polygon area
+    lease = lease or _Lease(None)
     local_mask = None
     if mask is not None:
         local_mask = mask
     else:
-        local_mask = np.zeros((h, w), np.uint8)
+        local_mask = lease.buf("poly_mask", (h, w), zero=True)
         cnt = np.array(ring, dtype=np.int32).reshape(-1,1,2)
         cv2.fillPoly(local_mask, [cnt], 255)
-    segs = _detect_interior_lines(img, local_mask, max_lines=200 if aggressive else 120, aggressive=aggressive)
+    segs = _detect_interior_lines(img, local_mask, max_lines=200 if aggressive else 120, aggressive=aggressive, lease=lease, lines=lines)
     if not segs:
         return [ring]
     # Keep segments mostly inside polygon and extend to bounds before splitting
@@ -356,108 +1206,283 @@ def _ensure_connectivity(polys: List[List[List[int]]], snap_gap: float = 14.0, b
                 pass
     return connected + bridges
 
-def remove_border_connected(mask: np.ndarray) -> np.ndarray:
+def remove_border_connected(mask: np.ndarray, lease: Optional["_Lease"] = None) -> np.ndarray:
+    lease = lease or _Lease(None)
     h, w = mask.shape[:2]
-    ff_mask = np.zeros((h+2, w+2), np.uint8)
-    mask_ff = mask.copy()
+    ff_mask = lease.buf("ff_mask", (h+2, w+2), zero=True)
+    mask_ff = lease.buf("border_free", (h, w))
+    np.copyto(mask_ff, mask)
     # Flood fill from the four corners to find background connected to border
     for pt in [(0,0), (w-1,0), (0,h-1), (w-1,h-1)]:
         cv2.floodFill(mask_ff, ff_mask, pt, 128)
     # Everything marked 128 is background; restore roof candidates (255)
-    mask_ff[mask_ff == 128] = 0
+    cv2.threshold(mask_ff, 128, 255, cv2.THRESH_BINARY, dst=mask_ff)
     return mask_ff
 
-def segment_roof(img: np.ndarray) -> np.ndarray:
+def segment_roof(img: np.ndarray, lease: Optional["_Lease"] = None) -> np.ndarray:
+    """Heuristic roof mask. Full-frame intermediates live in `lease` slots and are written in place
+    (dst=/out=), so a pooled lease keeps per-request allocations flat."""
+    lease = lease or _Lease(None)
     h, w = img.shape[:2]
     # 1) Initial GrabCut with center rectangle to bias toward central structure
     rect = (int(0.15*w), int(0.15*h), int(0.70*w), int(0.70*h))
-    mask = np.zeros((h, w), np.uint8)
+    mask = lease.buf("gc_mask", (h, w), zero=True)
     bgModel = np.zeros((1, 65), np.float64)
     fgModel = np.zeros((1, 65), np.float64)
+    grab = lease.buf("grab", (h, w))
     try:
         cv2.grabCut(img, mask, rect, bgModel, fgModel, 5, cv2.GC_INIT_WITH_RECT)
-        grab = np.where((mask == cv2.GC_FGD) | (mask == cv2.GC_PR_FGD), 255, 0).astype('uint8')
+        # GC_FGD (1) and GC_PR_FGD (3) are the odd labels
+        np.bitwise_and(mask, 1, out=grab)
+        np.multiply(grab, 255, out=grab)
     except Exception:
         # Fallback to edges if GrabCut fails
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        edges = cv2.Canny(gray, 60, 160)
-        grab = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, np.ones((5,5), np.uint8), iterations=2)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=lease.buf("gray", (h, w)))
+        edges = cv2.Canny(gray, 60, 160, edges=mask)
+        cv2.morphologyEx(edges, cv2.MORPH_CLOSE, np.ones((5,5), np.uint8), dst=grab, iterations=2)
 
     # 2) Remove green vegetation (HSV) to avoid lawns/trees
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV, dst=lease.buf("hsv", (h, w, 3)))
     # Broad green range
     green1 = np.array([35, 30, 30], dtype=np.uint8)
     green2 = np.array([90, 255, 255], dtype=np.uint8)
-    green_mask = cv2.inRange(hsv, green1, green2)
-    non_green = cv2.bitwise_not(green_mask)
-    mask_ng = cv2.bitwise_and(grab, non_green)
+    green_mask = cv2.inRange(hsv, green1, green2, dst=lease.buf("green", (h, w)))
+    non_green = cv2.bitwise_not(green_mask, dst=green_mask)
+    mask_ng = cv2.bitwise_and(grab, non_green, dst=grab)
 
     # 3) Morphological cleanup
     kernel = np.ones((5,5), np.uint8)
-    closed = cv2.morphologyEx(mask_ng, cv2.MORPH_CLOSE, kernel, iterations=2)
-    opened = cv2.morphologyEx(closed, cv2.MORPH_OPEN, np.ones((3,3), np.uint8), iterations=1)
+    closed = cv2.morphologyEx(mask_ng, cv2.MORPH_CLOSE, kernel, dst=green_mask, iterations=2)
+    opened = cv2.morphologyEx(closed, cv2.MORPH_OPEN, np.ones((3,3), np.uint8), dst=mask, iterations=1)
 
     # 4) Remove components connected to the image border (likely background)
-    interior = remove_border_connected(opened)
+    interior = remove_border_connected(opened, lease)
 
     # 5) Keep regions intersecting a center box to avoid far-away blobs
     center_box = (int(0.2*w), int(0.2*h), int(0.6*w), int(0.6*h))
     x0, y0, ww, hh = center_box
-    center_roi = np.zeros_like(interior)
-    center_roi[y0:y0+hh, x0:x0+ww] = 255
-    keep = cv2.bitwise_and(interior, center_roi)
+    keep = lease.buf("keep", (h, w), zero=True)
+    keep[y0:y0+hh, x0:x0+ww] = interior[y0:y0+hh, x0:x0+ww]
     # If too small, fall back to interior
     if cv2.countNonZero(keep) < 1500:
         keep = interior
 
     # Final smooth and binarize
-    keep = cv2.medianBlur(keep, 5)
-    _, binary = cv2.threshold(keep, 127, 255, cv2.THRESH_BINARY)
+    binary = cv2.medianBlur(keep, 5, dst=lease.buf("seg_binary", (h, w)))
+    cv2.threshold(binary, 127, 255, cv2.THRESH_BINARY, dst=binary)
     return binary
 
-def split_mask_into_planes(mask: np.ndarray, img: np.ndarray) -> np.ndarray:
+def split_mask_into_planes(mask: np.ndarray, img: np.ndarray, lease: Optional["_Lease"] = None, lines: Optional[str] = None) -> np.ndarray:
     # Detect strong lines inside the mask and use them to split regions
+    lease = lease or _Lease(None)
     h, w = img.shape[:2]
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    blur = cv2.GaussianBlur(gray, (5,5), 0)
-    edges = cv2.Canny(blur, 50, 150)
-    edges = cv2.bitwise_and(edges, edges, mask=mask)
-
-    lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=60, minLineLength=int(0.12*min(h,w)), maxLineGap=12)
-    cuts = np.zeros_like(mask)
-    if lines is not None:
-        for l in lines:
-            x1,y1,x2,y2 = l[0]
-            cv2.line(cuts, (x1,y1), (x2,y2), 255, thickness=3)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=lease.buf("gray", (h, w)))
+    blur = cv2.GaussianBlur(gray, (5,5), 0, dst=lease.buf("blur", (h, w)))
+
+    segs = _LINES.detect(blur, mask, "planes", lines)
+    if not len(segs):
+        return mask
+    cuts = lease.buf("cuts", (h, w), zero=True)
+    for x1, y1, x2, y2 in np.rint(segs).astype(np.int32).tolist():
+        cv2.line(cuts, (x1,y1), (x2,y2), 255, thickness=3)
     # Dilate cuts to ensure separation
     if np.count_nonzero(cuts) > 0:
-        cuts = cv2.dilate(cuts, np.ones((3,3), np.uint8), iterations=1)
-        split = cv2.bitwise_and(mask, cv2.bitwise_not(cuts))
+        grown = cv2.dilate(cuts, np.ones((3,3), np.uint8), dst=blur, iterations=1)
+        cv2.bitwise_not(grown, dst=grown)
+        split = cv2.bitwise_and(mask, grown, dst=cuts)
         # A bit of opening to remove thin leftovers
-        split = cv2.morphologyEx(split, cv2.MORPH_OPEN, np.ones((3,3), np.uint8), iterations=1)
-        return split
+        return cv2.morphologyEx(split, cv2.MORPH_OPEN, np.ones((3,3), np.uint8), dst=lease.buf("planes", (h, w)), iterations=1)
     return mask
 
+# --- Single-flight coalescing ---
+# The editor's auto-detect and API retries often post the same image several times within a
+# second. Identical in-flight requests (same content hash + normalized parameters) share one
+# computation; duplicates get the same response with an X-Coalesced header.
+SINGLE_FLIGHT = os.environ.get("AI_SINGLE_FLIGHT", "1").strip().lower() not in ("0", "false", "off", "no")
+
+class _SingleFlight:
+    """The first caller for a key starts the computation as its own task; every caller, the first
+    included, awaits it shielded, so a disconnecting client cancels neither it nor the others."""
+    def __init__(self):
+        self._inflight: dict = {}
+
+    async def do(self, key: str, fn) -> Tuple[object, bool]:
+        task = self._inflight.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        return await asyncio.shield(task), shared
+
+    def _finish(self, key: str, task: "asyncio.Future"):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved when every caller has gone
+
+_FLIGHTS = _SingleFlight()
+
+async def _coalesced(key: str, fn) -> JSONResponse:
+    """Run fn() -> (payload, status) at most once per in-flight key and build the response."""
+    if SINGLE_FLIGHT:
+        (payload, status), shared = await _FLIGHTS.do(key, fn)
+    else:
+        (payload, status), shared = await fn(), False
+    return JSONResponse(payload, status_code=status, headers={"X-Coalesced": "1"} if shared else None)
+
+# --- Tiled image pyramids (DeepZoom layout) for stitched output ---
+TILES_DIR = AI_DATA_DIR / "tiles"
+TILE_SIZE = int(os.environ.get("AI_TILE_SIZE", "256"))
+TILE_OVERLAP = int(os.environ.get("AI_TILE_OVERLAP", "1"))
+TILE_QUALITY = int(os.environ.get("AI_TILE_QUALITY", "85"))
+TILE_WORKERS = int(os.environ.get("AI_TILE_WORKERS", "0")) or INTRA_THREADS
+TILE_TTL_S = float(os.environ.get("AI_TILE_TTL_HOURS", "24")) * 3600.0  # 0 = keep forever
+TILE_MAX_BYTES = int(float(os.environ.get("AI_TILE_MAX_MB", "2048")) * 1024 * 1024)  # 0 = no cap
+_PYRAMID_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+_TILE_NAME_RE = re.compile(r"^\d+_\d+\.jpg$")
+
+def _write_tile_pyramid(img: np.ndarray, out_dir: Path, tile_size: int = TILE_SIZE, overlap: int = TILE_OVERLAP, quality: int = TILE_QUALITY) -> dict:
+    """Write img as a DeepZoom pyramid under out_dir (image.dzi plus image_files/<level>/<col>_<row>.jpg,
+    the layout DZI viewers resolve relative to the descriptor).
+    Level N is full resolution and each lower level halves it down to 1x1. Tiles of a level
+    are encoded in parallel (cv2 releases the GIL). Returns the level table for the manifest."""
+    h, w = img.shape[:2]
+    max_level = int(math.ceil(math.log2(max(w, h)))) if max(w, h) > 1 else 0
+    params = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+    levels = []
+
+    def write_tile(level_img, level_dir, col, row):
+        lh, lw = level_img.shape[:2]
+        x0 = max(0, col * tile_size - overlap); y0 = max(0, row * tile_size - overlap)
+        x1 = min(lw, (col + 1) * tile_size + overlap); y1 = min(lh, (row + 1) * tile_size + overlap)
+        ok, jpg = cv2.imencode(".jpg", level_img[y0:y1, x0:x1], params)
+        if not ok:
+            raise RuntimeError(f"Tile encode failed at {level_dir.name}/{col}_{row}")
+        (level_dir / f"{col}_{row}.jpg").write_bytes(jpg.tobytes())
+
+    with ThreadPoolExecutor(max_workers=TILE_WORKERS) as pool:
+        level_img = img
+        for level in range(max_level, -1, -1):
+            lh, lw = level_img.shape[:2]
+            cols, rows = int(math.ceil(lw / tile_size)), int(math.ceil(lh / tile_size))
+            level_dir = out_dir / "image_files" / str(level)
+            level_dir.mkdir(parents=True, exist_ok=True)
+            futs = [pool.submit(write_tile, level_img, level_dir, c, r) for r in range(rows) for c in range(cols)]
+            for fut in futs:
+                fut.result()
+            levels.append({"level": level, "width": lw, "height": lh, "cols": cols, "rows": rows})
+            if level > 0:
+                nw, nh = max(1, (lw + 1) // 2), max(1, (lh + 1) // 2)
+                level_img = cv2.resize(level_img, (nw, nh), interpolation=cv2.INTER_AREA)
+    (out_dir / "image.dzi").write_text(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="jpg" Overlap="{overlap}" TileSize="{tile_size}">'
+        f'<Size Width="{w}" Height="{h}"/></Image>\n')
+    levels.reverse()
+    return {"maxLevel": max_level, "levels": levels}
+
+def _tile_manifest(pyramid_id: str, w: int, h: int, table: dict) -> dict:
+    base = f"/tiles/{pyramid_id}"
+    return {
+        "id": pyramid_id,
+        "format": "deepzoom",
+        "width": int(w),
+        "height": int(h),
+        "tileSize": TILE_SIZE,
+        "overlap": TILE_OVERLAP,
+        "tileFormat": "jpg",
+        "maxLevel": table["maxLevel"],
+        "levels": table["levels"],
+        "dziUrl": f"{base}/image.dzi",
+        "tileUrlTemplate": base + "/image_files/{level}/{col}_{row}.jpg",
+    }
+
+def _dir_bytes(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.stat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+def _prune_tiles():
+    """Drop pyramids older than AI_TILE_TTL_HOURS, then the oldest until AI_TILE_MAX_MB fits.
+    Pyramids still being written (no manifest yet) are only removed by age."""
+    if not TILES_DIR.is_dir():
+        return
+    now = time.time()
+    done = []
+    for d in TILES_DIR.iterdir():
+        if not d.is_dir() or not _PYRAMID_ID_RE.match(d.name):
+            continue
+        try:
+            age = now - d.stat().st_mtime
+        except OSError:
+            continue
+        if TILE_TTL_S > 0 and age > TILE_TTL_S:
+            shutil.rmtree(d, ignore_errors=True)
+        elif (d / "manifest.json").is_file():
+            done.append((age, d))
+    if TILE_MAX_BYTES <= 0:
+        return
+    sized = [(age, d, _dir_bytes(d)) for age, d in done]
+    total = sum(s for _, _, s in sized)
+    for age, d, size in sorted(sized, key=lambda x: -x[0]):
+        if total <= TILE_MAX_BYTES:
+            break
+        shutil.rmtree(d, ignore_errors=True)
+        total -= size
+
+@app.get("/tiles/{pyramid_id}/{name}")
+def tile_pyramid_file(pyramid_id: str, name: str):
+    if not _PYRAMID_ID_RE.match(pyramid_id) or name not in ("image.dzi", "manifest.json"):
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    path = TILES_DIR / pyramid_id / name
+    if not path.is_file():
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    return FileResponse(path, media_type="application/xml" if name.endswith(".dzi") else "application/json")
+
+@app.get("/tiles/{pyramid_id}/image_files/{level}/{name}")
+def tile(pyramid_id: str, level: int, name: str):
+    if not _PYRAMID_ID_RE.match(pyramid_id) or not _TILE_NAME_RE.match(name) or level < 0:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    path = TILES_DIR / pyramid_id / "image_files" / str(level) / name
+    if not path.is_file():
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
 @app.post("/stitch")
-async def stitch(files: List[UploadFile] = File(default=[]), file: List[UploadFile] = File(default=[])):
-    # Read all images from 'files' or 'file'
+async def stitch(files: List[UploadFile] = File(default=[]), file: List[UploadFile] = File(default=[]), output: Optional[str] = None):
+    """Stitch overlapping photos. output=tiles writes a DeepZoom pyramid under AI_DATA_DIR/tiles
+    and returns its manifest instead of an inline base64 JPEG."""
     inputs = files + file
-    # Read all images
-    bufs: List[bytes] = []
-    for f in inputs:
-        try:
-            b = await f.read()
-            if b:
-                bufs.append(b)
-        except Exception:
-            pass
-    if len(bufs) < 2:
+    if any(_upload_size(f) > MAX_UPLOAD_BYTES for f in inputs):
+        return JSONResponse({"error": f"Image exceeds {MAX_UPLOAD_BYTES} bytes"}, status_code=413)
+    uploads = [f for f in inputs if _upload_size(f) > 0]
+    if len(uploads) < 2:
         return JSONResponse({"error": "Need at least 2 images"}, status_code=400)
+    maps = [_map_upload(f) for f in uploads]
+    leader = []
+    def start():
+        leader.append(True)
+        return _STAGES.run("stitch", _stitch_maps, maps, output)
+    try:
+        key = "stitch:" + (output or "").lower() + ":" + ",".join(await asyncio.to_thread(_digests, maps))
+        return await _coalesced(key, start)
+    finally:
+        if not leader:
+            for mm in maps:
+                _unmap(mm)
 
+def _stitch_maps(maps: list, output: Optional[str]) -> Tuple[dict, int]:
+    # Decode one upload at a time and unmap it, so only downscaled frames accumulate
     imgs = []
-    for b in bufs:
-        arr = np.frombuffer(b, np.uint8)
-        im = cv2.imdecode(arr, cv2.IMREAD_COLOR)
+    for mm in maps:
+        im = cv2.imdecode(np.frombuffer(mm, np.uint8), cv2.IMREAD_COLOR)
+        _unmap(mm)
         if im is None:
             continue
         # Optional downscale for speed if very large
@@ -467,52 +1492,415 @@ async def stitch(files: List[UploadFile] = File(default=[]), file: List[UploadFi
             im = cv2.resize(im, (int(w*scale), int(h*scale)))
         imgs.append(im)
     if len(imgs) < 2:
-        return JSONResponse({"error": "Failed to decode images"}, status_code=400)
+        return {"error": "Failed to decode images"}, 400
+    return _stitch_images(imgs, output)
 
-    # Try SCANS mode for near-planar nadir images; fallback to PANORAMA
-    try:
-        stitcher = cv2.Stitcher_create(cv2.Stitcher_SCANS)
-    except Exception:
-        stitcher = cv2.Stitcher_create()
-    status, pano = stitcher.stitch(imgs)
-    if status != cv2.Stitcher_OK:
-        # fallback try with PANORAMA
+def _stitch_images(imgs: List[np.ndarray], output: Optional[str]) -> Tuple[dict, int]:
+    with _STAGES.stage("stitch"):
+        # Try SCANS mode for near-planar nadir images; fallback to PANORAMA
         try:
-            stitcher2 = cv2.Stitcher_create(cv2.Stitcher_PANORAMA)
-            status2, pano2 = stitcher2.stitch(imgs)
-            if status2 == cv2.Stitcher_OK:
-                pano = pano2
-            else:
-                return JSONResponse({"error": f"Stitch failed: {status}"}, status_code=500)
+            stitcher = cv2.Stitcher_create(cv2.Stitcher_SCANS)
         except Exception:
-            return JSONResponse({"error": f"Stitch failed: {status}"}, status_code=500)
+            stitcher = cv2.Stitcher_create()
+        status, pano = stitcher.stitch(imgs)
+        if status != cv2.Stitcher_OK:
+            # fallback try with PANORAMA
+            try:
+                stitcher2 = cv2.Stitcher_create(cv2.Stitcher_PANORAMA)
+                status2, pano2 = stitcher2.stitch(imgs)
+                if status2 == cv2.Stitcher_OK:
+                    pano = pano2
+                else:
+                    return {"error": f"Stitch failed: {status}"}, 500
+            except Exception:
+                return {"error": f"Stitch failed: {status}"}, 500
+
+    if isinstance(output, str) and output.lower() in ("tiles", "dzi", "deepzoom"):
+        _prune_tiles()
+        pyramid_id = uuid.uuid4().hex
+        out_dir = TILES_DIR / pyramid_id
+        try:
+            table = _write_tile_pyramid(pano, out_dir)
+        except Exception as e:
+            return {"error": f"Tile write failed: {e}"}, 500
+        h, w = pano.shape[:2]
+        manifest = _tile_manifest(pyramid_id, w, h, table)
+        (out_dir / "manifest.json").write_text(json.dumps(manifest))
+        return {"tiles": manifest, "width": int(w), "height": int(h)}, 200
 
     ok, jpg = cv2.imencode(".jpg", pano, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
     if not ok:
-        return JSONResponse({"error": "Encode failed"}, status_code=500)
+        return {"error": "Encode failed"}, 500
     import base64
     b64 = base64.b64encode(jpg.tobytes()).decode("ascii")
     h, w = pano.shape[:2]
-    return JSONResponse({"image": "data:image/jpeg;base64," + b64, "width": int(w), "height": int(h)})
+    return {"image": "data:image/jpeg;base64," + b64, "width": int(w), "height": int(h)}, 200
+
+# --- Near-duplicate index (perceptual hashes + BK-tree) ---
+# Re-exported JPEGs, slight crops and re-synced flights hash within a small Hamming radius of an
+# earlier upload; /measure then warps that upload's polygons onto the new image instead of
+# re-running segmentation. Records live in AI_DATA_DIR/dedup (<id>.json + <id>.png thumbnail).
+DEDUP_ENABLED = os.environ.get("AI_DEDUP", "1").strip().lower() not in ("0", "false", "off", "no")
+DEDUP_DIR = AI_DATA_DIR / "dedup"
+DEDUP_RADIUS = int(os.environ.get("AI_DEDUP_RADIUS", "6"))  # max Hamming distance (of 64 bits)
+DEDUP_GPS_M = float(os.environ.get("AI_DEDUP_GPS_M", "30"))
+DEDUP_MAX_RECORDS = int(os.environ.get("AI_DEDUP_MAX_RECORDS", "5000"))  # 0 = unlimited
+DEDUP_TTL_S = float(os.environ.get("AI_DEDUP_TTL_DAYS", "30")) * 86400.0  # 0 = never expire
+DEDUP_THUMB = 512
+
+def _engine_tag(yolo) -> str:
+    if yolo is None:
+        return "heuristic"
+    try:
+        return f"yolo:{int(WEIGHTS_PATH.stat().st_mtime)}"
+    except Exception:
+        return "yolo"
+
+def _image_hashes(img: np.ndarray) -> Tuple[int, int]:
+    """64-bit (pHash, dHash) of a BGR image."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    ph_bits = low > np.median(low[1:])
+    tiny = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    dh_bits = (tiny[:, 1:] > tiny[:, :-1]).flatten()
+    to_int = lambda bits: int("".join("1" if b else "0" for b in bits), 2)
+    return to_int(ph_bits), to_int(dh_bits)
+
+def _hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+def _thumb(img: np.ndarray) -> np.ndarray:
+    h, w = img.shape[:2]
+    s = min(1.0, DEDUP_THUMB / float(max(h, w)))
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    if s >= 1.0:
+        return gray.copy()
+    return cv2.resize(gray, (max(1, int(w * s)), max(1, int(h * s))), interpolation=cv2.INTER_AREA)
+
+def _gps_distance_m(a: dict, b: dict) -> Optional[float]:
+    if "gps_lat" not in a or "gps_lat" not in b:
+        return None
+    lat = math.radians((a["gps_lat"] + b["gps_lat"]) / 2.0)
+    dx = math.radians(b["gps_lon"] - a["gps_lon"]) * math.cos(lat)
+    dy = math.radians(b["gps_lat"] - a["gps_lat"])
+    return 6371000.0 * math.hypot(dx, dy)
+
+def _align_thumbs(src: np.ndarray, dst: np.ndarray) -> Tuple[Optional[np.ndarray], int]:
+    """Homography mapping src thumbnail pixels onto dst thumbnail pixels (ORB + RANSAC)."""
+    orb = cv2.ORB_create(1000)
+    k1, d1 = orb.detectAndCompute(src, None)
+    k2, d2 = orb.detectAndCompute(dst, None)
+    if d1 is None or d2 is None or len(k1) < 12 or len(k2) < 12:
+        return None, 0
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(d1, d2)
+    if len(matches) < 12:
+        return None, 0
+    p1 = np.float32([k1[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
+    p2 = np.float32([k2[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
+    H, inl = cv2.findHomography(p1, p2, cv2.RANSAC, 3.0)
+    n = int(inl.sum()) if inl is not None else 0
+    if H is None or n < 15 or n < 0.25 * len(matches):
+        return None, n
+    # Reject folds and wild rescales; re-exports and crops are close to a similarity
+    det = float(np.linalg.det(H[:2, :2]))
+    if not (0.5 < det < 2.0):
+        return None, n
+    return H, n
+
+class _BKTree:
+    """Burkhard-Keller tree over 64-bit hashes for Hamming-radius queries."""
+    def __init__(self):
+        self.root = None  # [hash, [items], {distance: child}]
+
+    def add(self, h: int, item):
+        if self.root is None:
+            self.root = [h, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = _hamming(h, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, [item], {}]
+                return
+            node = child
+
+    def search(self, h: int, radius: int) -> List[Tuple[int, object]]:
+        out = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = _hamming(h, node[0])
+            if d <= radius:
+                out.extend((d, it) for it in node[1])
+            for cd, child in node[2].items():
+                if d - radius <= cd <= d + radius:
+                    stack.append(child)
+        return sorted(out, key=lambda x: x[0])
+
+    def remove(self, h: int, item):
+        # Emptied nodes stay in place as routing nodes for their children
+        node = self.root
+        while node is not None:
+            d = _hamming(h, node[0])
+            if d == 0:
+                if item in node[1]:
+                    node[1].remove(item)
+                return
+            node = node[2].get(d)
+
+class _NearDupIndex:
+    """In-memory BK-tree over stored measurement hashes; polygons and thumbnails stay on disk.
+    Records expire after AI_DEDUP_TTL_DAYS and the oldest are evicted past AI_DEDUP_MAX_RECORDS."""
+    def __init__(self, root: Path):
+        self.root = root
+        self._tree = _BKTree()
+        self._meta: dict = {}
+        self._dead = 0  # evicted ids whose (now empty) tree nodes are still in place
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not self.root.is_dir():
+            return
+        recs = []
+        for f in self.root.glob("*.json"):
+            try:
+                rec = json.loads(f.read_text())
+                rec.setdefault("createdAt", int(f.stat().st_mtime))
+                recs.append(rec)
+            except Exception:
+                continue
+        # Oldest first, so _meta's insertion order is age order
+        for rec in sorted(recs, key=lambda r: r["createdAt"]):
+            self._insert(rec)
+        self._evict()
+
+    def _insert(self, rec: dict):
+        meta = {k: rec[k] for k in ("id", "phash", "dhash", "key", "datetime", "gps", "size", "thumbScale", "createdAt")}
+        with self._lock:
+            self._meta[meta["id"]] = meta
+            self._tree.add(int(meta["phash"], 16), meta["id"])
+
+    def _expired(self, meta: dict, now: float) -> bool:
+        return DEDUP_TTL_S > 0 and now - meta["createdAt"] > DEDUP_TTL_S
+
+    def _evict(self):
+        now = time.time()
+        dropped = []
+        with self._lock:
+            while self._meta:
+                meta = next(iter(self._meta.values()))
+                if not (self._expired(meta, now) or (DEDUP_MAX_RECORDS > 0 and len(self._meta) > DEDUP_MAX_RECORDS)):
+                    break
+                del self._meta[meta["id"]]
+                self._tree.remove(int(meta["phash"], 16), meta["id"])
+                self._dead += 1
+                dropped.append(meta["id"])
+            if self._dead > len(self._meta):
+                # BK-tree nodes cannot be unlinked; rebuild once dead entries outnumber live ones
+                self._tree = _BKTree()
+                for meta in self._meta.values():
+                    self._tree.add(int(meta["phash"], 16), meta["id"])
+                self._dead = 0
+        for rid in dropped:
+            for ext in ("json", "png"):
+                try:
+                    (self.root / f"{rid}.{ext}").unlink()
+                except OSError:
+                    pass
+
+    def lookup(self, img: np.ndarray, scale: float, hashes: Tuple[int, int], exif: dict, key: dict) -> Optional[dict]:
+        """Best aligned near-duplicate as {measureId, distance, dhashDistance, inliers, polygons}, polygons in original pixels."""
+        ph, dh = hashes
+        now = time.time()
+        with self._lock:
+            cands = [(d, self._meta[i]) for d, i in self._tree.search(ph, DEDUP_RADIUS)]
+        thumb = None
+        for d, meta in cands:
+            if self._expired(meta, now):
+                continue
+            dd = _hamming(dh, int(meta["dhash"], 16))
+            if meta["key"] != key or dd > DEDUP_RADIUS:
+                continue
+            # Same content but a different capture (e.g. a repeat flight) must be measured again
+            if meta.get("datetime") and exif.get("datetime") and meta["datetime"] != exif["datetime"]:
+                continue
+            gd = _gps_distance_m(meta.get("gps") or {}, exif)
+            if gd is not None and gd > DEDUP_GPS_M:
+                continue
+            try:
+                rec = json.loads((self.root / f"{meta['id']}.json").read_text())
+                old_thumb = cv2.imread(str(self.root / f"{meta['id']}.png"), cv2.IMREAD_GRAYSCALE)
+            except Exception:
+                continue
+            if old_thumb is None:
+                continue
+            if thumb is None:
+                thumb = _thumb(img)
+            H, inliers = _align_thumbs(old_thumb, thumb)
+            if H is None:
+                # Featureless re-export at another resolution: fall back to a pure rescale
+                sx, sy = thumb.shape[1] / old_thumb.shape[1], thumb.shape[0] / old_thumb.shape[0]
+                if d > 2 or dd > 2 or abs(sx - sy) > 0.01 * sx:
+                    continue
+                H = np.diag([sx, sy, 1.0])
+            # original(old) -> thumb(old) -> thumb(new) -> original(new)
+            w0, h0 = img.shape[1] / scale, img.shape[0] / scale
+            new_ts = thumb.shape[1] / w0
+            M = np.diag([1.0 / new_ts, 1.0 / new_ts, 1.0]) @ H @ np.diag([meta["thumbScale"], meta["thumbScale"], 1.0])
+            polys = []
+            for ring in rec["polygons"]:
+                pts = cv2.perspectiveTransform(np.array(ring, np.float64).reshape(-1, 1, 2), M).reshape(-1, 2)
+                pts[:, 0] = np.clip(pts[:, 0], 0, w0 - 1)
+                pts[:, 1] = np.clip(pts[:, 1], 0, h0 - 1)
+                if len(pts) >= 3 and cv2.contourArea(pts.astype(np.float32)) > 1.0:
+                    polys.append(pts.tolist())
+            if not polys:
+                continue
+            return {"measureId": meta["id"], "distance": d, "dhashDistance": dd, "inliers": inliers, "polygons": polys}
+        return None
+
+    def add(self, img: np.ndarray, scale: float, hashes: Tuple[int, int], exif: dict, key: dict, planes: List[dict]) -> Optional[str]:
+        rid = uuid.uuid4().hex
+        thumb = _thumb(img)
+        w0 = img.shape[1] / scale
+        rec = {
+            "id": rid,
+            "phash": f"{hashes[0]:016x}",
+            "dhash": f"{hashes[1]:016x}",
+            "key": key,
+            "datetime": exif.get("datetime"),
+            "gps": {k: exif[k] for k in ("gps_lat", "gps_lon") if k in exif},
+            "size": [int(round(w0)), int(round(img.shape[0] / scale))],
+            "thumbScale": thumb.shape[1] / w0,
+            "polygons": [p["polygon"] for p in planes],
+            "createdAt": int(time.time()),
+        }
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            cv2.imwrite(str(self.root / f"{rid}.png"), thumb)
+            (self.root / f"{rid}.json").write_text(json.dumps(rec))
+        except Exception:
+            return None
+        self._insert(rec)
+        self._evict()
+        return rid
+
+_DEDUP = _NearDupIndex(DEDUP_DIR)
+if DEDUP_ENABLED:
+    _DEDUP.load()
 
 @app.post("/measure")
-async def measure(file: UploadFile = File(...), assume_alt_agl_m: Optional[float] = None, default_pitch_in12: float = 6.0, focus_x: Optional[int] = None, focus_y: Optional[int] = None, split: Optional[str] = None):
-    img_b = await file.read()
+async def measure(file: UploadFile = File(...), assume_alt_agl_m: Optional[float] = None, default_pitch_in12: float = 6.0, focus_x: Optional[int] = None, focus_y: Optional[int] = None, split: Optional[str] = None, reuse: bool = True, lines: Optional[str] = None):
+    n = _upload_size(file)
+    if n > MAX_UPLOAD_BYTES:
+        return JSONResponse({"error": f"Image exceeds {MAX_UPLOAD_BYTES} bytes"}, status_code=413)
+    if n == 0:
+        return JSONResponse({"error": "Empty upload"}, status_code=400)
+    detector = _LINES.validate(lines)
+    if detector is None:
+        return JSONResponse({"error": f"Unknown line detector: {lines}", "available": _LINES.names()}, status_code=400)
+    params = [assume_alt_agl_m, float(default_pitch_in12), focus_x, focus_y, "aggressive" if _is_aggressive(split) else "default", bool(reuse), detector]
+    img_b = _map_upload(file)
+    # The map belongs to the shared computation when this request leads it, else to this request
+    leader = []
+    def start():
+        leader.append(True)
+        return _unmap_after(img_b, _measure_payload(img_b, assume_alt_agl_m, default_pitch_in12, focus_x, focus_y, split, reuse, detector))
+    try:
+        key = "measure:" + (await asyncio.to_thread(_digests, [img_b]))[0] + ":" + json.dumps(params)
+        return await _coalesced(key, start)
+    finally:
+        if not leader:
+            _unmap(img_b)
+
+def _digests(maps: list) -> List[str]:
+    # Off the event loop: a flight can be hundreds of MB (hashlib releases the GIL)
+    return [hashlib.sha256(mm).hexdigest() for mm in maps]
+
+async def _unmap_after(mm, coro):
+    try:
+        return await coro
+    finally:
+        _unmap(mm)
+
+async def _measure_payload(img_b, assume_alt_agl_m: Optional[float], default_pitch_in12: float, focus_x: Optional[int], focus_y: Optional[int], split: Optional[str], reuse: bool, lines: str) -> Tuple[dict, int]:
     exif = exif_from_bytes(img_b)
     gsd_m_per_px = compute_gsd(exif, assume_alt_agl_m)
 
-    img_arr = np.frombuffer(img_b, np.uint8)
-    img = cv2.imdecode(img_arr, cv2.IMREAD_COLOR)
+    # Admission control against the worker memory budget
+    size = _image_size(img_b)
+    need = _estimate_measure_bytes(size)
+    if MEM_BUDGET_BYTES > 0 and need > MEM_BUDGET_BYTES:
+        return {"error": "Image exceeds worker memory budget", "estimatedBytes": need, "budgetBytes": MEM_BUDGET_BYTES}, 413
+    if not await _MEM_BUDGET.acquire(need, MEM_QUEUE_TIMEOUT_S):
+        return {"error": "Worker memory budget busy, retry later", "estimatedBytes": need}, 503
+
+    def run():
+        rss0, _ = _rss_bytes()
+        with _Lease(_POOL if BOUNDED_MEMORY else None) as lease, _LINES.track() as line_ms:
+            result = _measure_image(img_b, size, lease, exif, gsd_m_per_px, default_pitch_in12, focus_x, focus_y, split, reuse, lines)
+            rss1, hwm = _rss_bytes()
+            memory = {
+                "mode": "bounded" if BOUNDED_MEMORY else "default",
+                "estimatedBytes": need,
+                "leasedPeakBytes": lease.peak_bytes,
+                "poolBytes": _POOL.allocated_bytes,
+                "rssStartBytes": rss0,
+                "rssEndBytes": rss1,
+                "processRssHighWaterBytes": hwm,  # process lifetime, not this request
+            }
+        if result is not None:
+            result["lines"] = {"detector": lines, "backends": {k: {**v, "ms": round(v["ms"], 1)} for k, v in line_ms.items()}}
+        return result, memory
+    # The reservation follows the worker thread, which keeps running if this request is cancelled
+    work = asyncio.ensure_future(_STAGES.run("measure", run))
+    work.add_done_callback(lambda f: _release_after(f, need))
+    result, memory = await asyncio.shield(work)
+    if result is None:
+        return {"error": "Invalid image"}, 400
+    result["memory"] = memory
+    return result, 200
+
+def _release_after(fut: "asyncio.Future", nbytes: int):
+    if not fut.cancelled():
+        fut.exception()  # retrieved here; the awaiting request re-raises it
+    asyncio.ensure_future(_MEM_BUDGET.release(nbytes))
+
+def _is_aggressive(split: Optional[str]) -> bool:
+    return isinstance(split, str) and split.lower() in ("aggr", "aggressive", "max")
+
+def _measure_image(img_b, size: Optional[Tuple[int, int]], lease: _Lease, exif: dict, gsd_m_per_px: float, default_pitch_in12: float = 6.0, focus_x: Optional[int] = None, focus_y: Optional[int] = None, split: Optional[str] = None, reuse: bool = True, lines: Optional[str] = None) -> Optional[dict]:
+    """Run the /measure pipeline on raw image bytes; returns the response dict or None if the image is invalid.
+    Processing happens at working resolution; polygons and areas are reported in original pixels."""
+    img, scale = _decode_for_work(img_b, size, lease)
     if img is None:
-        return JSONResponse({"error": "Invalid image"}, status_code=400)
+        return None
     h, w = img.shape[:2]
 
+    # Near-duplicate of an earlier upload: warm-start from its polygons and skip segmentation
+    yolo = _maybe_load_model()
+    dedup_key = None
+    if DEDUP_ENABLED and reuse and focus_x is None and focus_y is None:
+        dedup_key = {"split": "aggressive" if _is_aggressive(split) else "default", "engine": _engine_tag(yolo), "lines": lines or _LINES.default}
+        hashes = _image_hashes(img)
+        hit = _DEDUP.lookup(img, scale, hashes, exif, dedup_key)
+        if hit is not None:
+            polys_work = [[[int(round(x * scale)), int(round(y * scale))] for x, y in ring] for ring in hit.pop("polygons")]
+            result = _build_measure_result(img, scale, polys_work, lease, exif, gsd_m_per_px, default_pitch_in12, lines)
+            result["nearDuplicate"] = hit
+            return result
+
     # If YOLO weights available, run instance segmentation; else use heuristics
     polys = []
-    yolo = _maybe_load_model()
     if yolo is not None:
         try:
-            preds = yolo.predict(source=img, imgsz=1024, conf=0.25, verbose=False)[0]
+            with _STAGES.stage("inference"), _model_instance(yolo) as model:
+                preds = model.predict(source=img, imgsz=1024, conf=0.25, verbose=False)[0]
             ms = preds.masks.data.cpu().numpy() if getattr(preds, 'masks', None) is not None else []
             if len(ms):
                 # Convert masks to polygons
@@ -528,43 +1916,54 @@ async def measure(file: UploadFile = File(...), assume_alt_agl_m: Optional[float
                             polys.append(ring)
         except Exception:
             polys = []
-    if not polys:
-        # Heuristic fallback
-        mask = segment_roof(img)
-        mask_planes = split_mask_into_planes(mask, img)
-        polys = polygonize(mask_planes)
-    # Split any polygon using detected interior lines (aggressive if requested)
-    aggressive = (isinstance(split, str) and split.lower() in ("aggr", "aggressive", "max"))
+    aggressive = _is_aggressive(split)
     improved_polys: List[list] = []
-    for poly_ring in polys:
-        improved_polys.extend(_split_polygon_by_lines(poly_ring, img, mask=None, aggressive=aggressive))
+    with _STAGES.stage("segment"):
+        if not polys:
+            # Heuristic fallback
+            mask = segment_roof(img, lease)
+            mask_planes = split_mask_into_planes(mask, img, lease, lines)
+            polys = polygonize(mask_planes)
+        # Split any polygon using detected interior lines (aggressive if requested)
+        for poly_ring in polys:
+            improved_polys.extend(_split_polygon_by_lines(poly_ring, img, mask=None, aggressive=aggressive, lease=lease, lines=lines))
 
     # Filter away neighboring roofs (cluster filtering)
     focus = None
     if isinstance(focus_x, int) and isinstance(focus_y, int):
-        if 0 <= focus_x < w and 0 <= focus_y < h:
-            focus = (focus_x, focus_y)
+        fx, fy = int(focus_x * scale), int(focus_y * scale)
+        if 0 <= fx < w and 0 <= fy < h:
+            focus = (fx, fy)
     improved_polys = _cluster_filter(improved_polys, (h, w), focus)
     # Enforce connectivity (snap + bridge)
     improved_polys = _ensure_connectivity(improved_polys)
 
+    result = _build_measure_result(img, scale, improved_polys, lease, exif, gsd_m_per_px, default_pitch_in12, lines)
+    if dedup_key is not None:
+        result["measureId"] = _DEDUP.add(img, scale, hashes, exif, dedup_key, result["planes"])
+    return result
+
+def _build_measure_result(img: np.ndarray, scale: float, improved_polys: List[list], lease: _Lease, exif: dict, gsd_m_per_px: float, default_pitch_in12: float, lines: Optional[str] = None) -> dict:
+    """Areas, ridge angle and overlay for final polygons given in working-image coordinates."""
+    h, w = img.shape[:2]
     mpp = gsd_m_per_px
     to_ft = 3.28084
     planes = []
     total_plan_area_ft2 = 0.0
     total_perimeter_ft = 0.0
 
-    overlay = img.copy()
+    overlay = lease.buf("overlay", img.shape)
+    np.copyto(overlay, img)
     # Optional: estimate rotation to align dominant ridge with X-axis
     angleDeg_out: Optional[float] = None
     try:
         # Use detected interior lines (aggressive to emphasize ridges)
         mask0 = None
         if improved_polys:
-            mask0 = np.zeros((h, w), np.uint8)
+            mask0 = lease.buf("ridge_mask", (h, w), zero=True)
             for poly in improved_polys:
                 cv2.fillPoly(mask0, [np.array(poly, dtype=np.int32)], 255)
-        segs_est = _detect_interior_lines(img, mask0, max_lines=200, aggressive=True)
+        segs_est = _detect_interior_lines(img, mask0, max_lines=200, aggressive=True, lease=lease, lines=lines)
         if segs_est:
             angles = []
             for (a,b) in segs_est:
@@ -583,7 +1982,9 @@ async def measure(file: UploadFile = File(...), assume_alt_agl_m: Optional[float
                 angleDeg_out = -float(center)
     except Exception:
         angleDeg_out = None
-    for i, poly in enumerate(improved_polys):
+    for i, work_poly in enumerate(improved_polys):
+        # Back to original pixel coordinates (identity unless bounded mode downscaled)
+        poly = work_poly if scale == 1.0 else [[int(round(x / scale)), int(round(y / scale))] for x, y in work_poly]
         p = np.array(poly, dtype=np.float32)
         area_px = cv2.contourArea(p)
         perim_px = cv2.arcLength(p, True)
@@ -612,8 +2013,9 @@ async def measure(file: UploadFile = File(...), assume_alt_agl_m: Optional[float
             "edges": edges,
         })
 
-        cv2.polylines(overlay, [p.astype(np.int32)], True, (0, 255, 0), 2)
-        M = p.mean(axis=0).astype(int)
+        wp = np.array(work_poly, dtype=np.int32)
+        cv2.polylines(overlay, [wp], True, (0, 255, 0), 2)
+        M = wp.mean(axis=0).astype(int)
         cv2.putText(overlay, f"P{i+1}", tuple(M), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0,0,255), 2)
 
     total_surface_ft2 = sum(p["surfaceAreaFt2"] for p in planes)
@@ -633,7 +2035,9 @@ async def measure(file: UploadFile = File(...), assume_alt_agl_m: Optional[float
     result = { "exif": exif, "gsd_m_per_px": gsd_m_per_px, "planes": planes, "edges": {}, "totals": totals, "overlay": overlay_b64 }
     if angleDeg_out is not None:
         result["angleDeg"] = angleDeg_out
-    return JSONResponse(result)
+    if scale != 1.0:
+        result["workScale"] = scale
+    return result
 
 @app.post("/feedback")
 async def feedback(data: dict):
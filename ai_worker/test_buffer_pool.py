@@ -0,0 +1,68 @@
+"""
+Unit tests for the bounded-memory buffer pool in main.py.
+
+Run: python -m pytest ai_worker/test_buffer_pool.py
+"""
+
+import os, sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+os.environ.setdefault("AI_DEDUP", "0")
+
+from main import _BufferPool, _Lease
+
+
+def _retained(pool: _BufferPool) -> int:
+    return sum(b.nbytes for free in pool._free.values() for b in free)
+
+
+def test_reuses_returned_buffer():
+    pool = _BufferPool(max_free_bytes=1 << 20)
+    a = pool.take((10, 20))
+    pool.give(a)
+    assert pool.take((10, 20)) is a
+    assert pool.allocated_bytes == 200
+
+
+def test_oversized_buffer_is_dropped_without_empty_free_list():
+    pool = _BufferPool(max_free_bytes=1000)
+    big = pool.take((100, 100))
+    pool.give(big)
+    assert (100, 100) not in pool._free
+    assert pool.free_bytes == 0 and pool.allocated_bytes == 0
+    # Later evictions must not trip over a leftover empty list
+    for shape in [(10, 30), (10, 40), (10, 50)]:
+        pool.give(pool.take(shape))
+    assert pool.free_bytes == _retained(pool) <= 1000
+
+
+def test_evicts_least_recently_returned_shape_first():
+    pool = _BufferPool(max_free_bytes=500)
+    old, new = pool.take((10, 30)), pool.take((10, 30))
+    pool.give(old)
+    other = pool.take((10, 20))
+    pool.give(other)
+    pool.give(new)  # 800 bytes idle > 500; returning (10, 30) again made (10, 20) the oldest shape
+    assert (10, 20) not in pool._free
+    assert pool._free[(10, 30)] == [new]
+    assert pool.free_bytes == pool.allocated_bytes == 300
+
+
+def test_per_shape_cap():
+    pool = _BufferPool(max_free_bytes=1 << 20, max_free_per_shape=2)
+    bufs = [pool.take((4, 4)) for _ in range(3)]
+    for b in bufs:
+        pool.give(b)
+    assert len(pool._free[(4, 4)]) == 2
+    assert pool.allocated_bytes == pool.free_bytes == 32
+
+
+def test_lease_release_accounts_all_slots_under_small_cap():
+    pool = _BufferPool(max_free_bytes=6 * 1024)
+    with _Lease(pool) as lease:
+        lease.buf("a", (100, 100))
+        lease.buf("b", (30, 30))
+        lease.buf("c", (40, 40, 3))
+    assert pool.free_bytes == _retained(pool) <= pool.max_free_bytes
+    assert pool.allocated_bytes == pool.free_bytes
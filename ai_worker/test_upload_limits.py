@@ -0,0 +1,106 @@
+"""
+Unit tests for the streaming upload limits in main.py.
+
+Run: python -m pytest ai_worker/test_upload_limits.py
+"""
+
+import asyncio, os, sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+os.environ.setdefault("AI_DEDUP", "0")
+
+from main import _BodyLimitMiddleware, _BodyTooLarge, _PartMeter, _multipart_boundary
+
+
+def _multipart(boundary: bytes, parts) -> bytes:
+    body = b""
+    for name, data in parts:
+        body += b"--" + boundary + b"\r\n"
+        body += b'Content-Disposition: form-data; name="files"; filename="' + name + b'"\r\n\r\n'
+        body += data + b"\r\n"
+    return body + b"--" + boundary + b"--\r\n"
+
+
+def _largest_part(body: bytes, boundary: bytes, chunk: int) -> int:
+    meter = _PartMeter(boundary)
+    return max(meter.feed(body[i:i + chunk]) for i in range(0, len(body), chunk))
+
+
+def test_boundary_from_content_type():
+    assert _multipart_boundary({b"content-type": b'multipart/form-data; boundary="abc"'}) == b"abc"
+    assert _multipart_boundary({b"content-type": b"multipart/form-data; charset=utf-8; boundary=xyz"}) == b"xyz"
+    assert _multipart_boundary({b"content-type": b"application/json"}) is None
+    assert _multipart_boundary({}) is None
+
+
+def test_part_meter_tracks_each_part_across_chunk_sizes():
+    boundary = b"----b0undary"
+    body = _multipart(boundary, [(b"a.jpg", b"x" * 5000), (b"b.jpg", b"y" * 300), (b"c.jpg", b"z" * 1200)])
+    for chunk in (1, 7, 13, 64, 1000, len(body)):
+        largest = _largest_part(body, boundary, chunk)
+        # The 5000-byte file plus its part headers, never the sum of all parts
+        assert 5000 <= largest < 5200, chunk
+
+
+def _run(mw, body: bytes, headers, path="/stitch", chunk=1024):
+    chunks = [body[i:i + chunk] for i in range(0, len(body), chunk)] or [b""]
+    sent = []
+
+    async def receive():
+        data = chunks.pop(0)
+        return {"type": "http.request", "body": data, "more_body": bool(chunks)}
+
+    async def send(msg):
+        sent.append(msg)
+
+    scope = {"type": "http", "method": "POST", "path": path, "headers": headers}
+
+    async def go():
+        try:
+            await mw(scope, receive, send)
+        except _BodyTooLarge as e:
+            return e
+        return None
+
+    return asyncio.run(go()), sent
+
+
+def _inner(received_bytes: list):
+    async def app(scope, receive, send):
+        while True:
+            msg = await receive()
+            received_bytes.append(len(msg.get("body", b"")))
+            if not msg.get("more_body"):
+                break
+    return app
+
+
+def test_oversized_part_is_cut_off_while_streaming():
+    boundary = b"bnd"
+    body = _multipart(boundary, [(b"a.jpg", b"x" * 2000), (b"b.jpg", b"y" * 20000), (b"c.jpg", b"z" * 2000)])
+    got = []
+    mw = _BodyLimitMiddleware(_inner(got), max_bytes=1 << 20, max_part_bytes=4096)
+    err, _ = _run(mw, body, [(b"content-type", b"multipart/form-data; boundary=bnd")])
+    assert isinstance(err, _BodyTooLarge) and "Upload part exceeds 4096" in err.detail
+    assert sum(got) < 2000 + 4096 + 2048  # stopped inside the oversized part
+
+
+def test_parts_under_cap_pass_even_when_total_exceeds_it():
+    boundary = b"bnd"
+    body = _multipart(boundary, [(b"%d.jpg" % i, b"x" * 3000) for i in range(5)])
+    got = []
+    mw = _BodyLimitMiddleware(_inner(got), max_bytes=1 << 20, max_part_bytes=4096)
+    err, _ = _run(mw, body, [(b"content-type", b"multipart/form-data; boundary=bnd")])
+    assert err is None and sum(got) == len(body)
+
+
+def test_route_limit_tightens_total_and_rejects_declared_length():
+    got = []
+    mw = _BodyLimitMiddleware(_inner(got), max_bytes=1 << 20, route_limits={"/measure": 1000})
+    err, _ = _run(mw, b"x" * 5000, [], path="/measure", chunk=256)
+    assert isinstance(err, _BodyTooLarge) and "Request body exceeds 1000" in err.detail
+    err, _ = _run(mw, b"x" * 5000, [], path="/stitch", chunk=256)
+    assert err is None
+    err, sent = _run(mw, b"x" * 5000, [(b"content-length", b"5000")], path="/measure")
+    assert err is None and sent[0]["status"] == 413